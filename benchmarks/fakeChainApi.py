@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+'''a local stand-in for ChainAPI serving a syntheticData.chain_graph as
+HAL+JSON, for benchmarking the processor without a network.  It serves the
+subset of ChainAPI the processor reads (sites, devices, sensors and paged,
+timestamp-filtered scalar data) and accepts the sensor and data posts it
+makes.'''
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import urlparse
+import threading
+import datetime
+import calendar
+import bisect
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.timestampNormalizer import parse_timestamp
+
+
+NAMESPACE = 'http://learnair.media.mit.edu:8000/rels/'
+
+#datapoints per dataHistory page
+PAGE_SIZE = 500
+
+
+def epoch_seconds(timestamp):
+    timestamp = parse_timestamp(timestamp)
+    if timestamp.tzinfo is not None:
+        return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+    return calendar.timegm(timestamp.timetuple()) + timestamp.microsecond / 1e6
+
+
+class threadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class fakeChainApi(object):
+    '''serve graph on host:port (port 0 picks a free port) in a background
+    thread.  posts counts the sensors and datapoints posted to it.'''
+
+    def __init__(self, graph, host='127.0.0.1', port=0):
+
+        self.lock = threading.Lock()
+        self.sites, self.devices, self.sensors = [], [], []
+        self.posts = {'sensors': 0, 'data': 0}
+
+        for site in graph['sites']:
+            site_id = len(self.sites)
+            self.sites.append({'name': site['name'], 'geoLocation': site['geoLocation']})
+            for device in site['devices']:
+                self.add_device(site_id, device)
+
+        api = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                api.handle(self, 'GET')
+
+            def do_POST(self):
+                api.handle(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = threadingServer((host, port), handler)
+        self.url = 'http://%s:%s' % self.server.server_address
+        self.thread = None
+
+
+    def add_device(self, site_id, device):
+        device_id = len(self.devices)
+        self.devices.append({'site': site_id, 'name': device['name'],
+                'geoLocation': device.get('geoLocation')})
+        for sensor in device['sensors']:
+            self.add_sensor(device_id, sensor)
+
+
+    def add_sensor(self, device_id, sensor):
+        '''add a sensor, its data kept sorted by time'''
+
+        data = sorted(sensor.get('data', []), key=lambda p: epoch_seconds(p['timestamp']))
+        with self.lock:
+            self.sensors.append({'device': device_id,
+                    'sensor_type': sensor['sensor_type'],
+                    'metric': sensor['metric'], 'unit': sensor['unit'],
+                    'title': sensor.get('title', sensor['metric']),
+                    'data': data,
+                    'times': [epoch_seconds(p['timestamp']) for p in data]})
+            return len(self.sensors) - 1
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def sensor_uris(self, sensor_type=None):
+        '''uris of every sensor (of sensor_type), in creation order'''
+        return [self.href('sensors', i) for i, s in enumerate(self.sensors)
+                if sensor_type is None or s['sensor_type'] == sensor_type]
+
+
+    def href(self, kind, resource_id=None, **query):
+        uri = '%s/%s/' % (self.url, kind)
+        if resource_id is not None:
+            uri += str(resource_id)
+        if query:
+            uri += '?' + '&'.join('%s=%s' % item for item in sorted(query.items()))
+        return uri
+
+
+    def resource(self, links, **fields):
+        links['curies'] = [{'name': 'ch', 'href': NAMESPACE + '{rel}', 'templated': True}]
+        fields['_links'] = links
+        return fields
+
+
+    def collection(self, kind, items, query, create=True):
+        links = {'self': {'href': self.href(kind, **query)},
+                'items': [{'href': self.href(kind, i), 'title': title}
+                        for i, title in items]}
+        if create:
+            links['createForm'] = {'href': self.href(kind, **query),
+                    'title': 'Create ' + kind[:-1].title()}
+        return self.resource(links, totalCount=len(items))
+
+
+    def handle(self, request, method):
+
+        parsed = urlparse.urlparse(request.path)
+        parts = [p for p in parsed.path.split('/') if p]
+        query = dict((k, v[0]) for k, v in urlparse.parse_qs(parsed.query).items())
+
+        try:
+            if method == 'POST':
+                length = int(request.headers.get('Content-Length', 0))
+                body = json.loads(request.rfile.read(length) or 'null')
+                status, value = self.post(parts, query, body)
+            else:
+                status, value = self.get(parts, query)
+        except (IndexError, ValueError, KeyError):
+            status, value = 404, {'error': 'not found'}
+
+        payload = json.dumps(value)
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/hal+json')
+        request.send_header('Content-Length', str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+
+    def get(self, parts, query):
+
+        if not parts:
+            return 200, self.resource({'self': {'href': self.url + '/'},
+                    'ch:sites': {'href': self.href('sites')}})
+
+        kind = parts[0]
+        resource_id = int(parts[1]) if len(parts) > 1 else None
+
+        if kind == 'sites' and resource_id is None:
+            return 200, self.collection('sites',
+                    [(i, s['name']) for i, s in enumerate(self.sites)], query, False)
+
+        if kind == 'sites':
+            site = self.sites[resource_id]
+            return 200, self.resource({'self': {'href': self.href('sites', resource_id)},
+                    'ch:devices': {'href': self.href('devices', site_id=resource_id)}},
+                    name=site['name'], geoLocation=site['geoLocation'])
+
+        if kind == 'devices' and resource_id is None:
+            site_id = int(query['site_id'])
+            return 200, self.collection('devices', [(i, d['name']) for i, d
+                    in enumerate(self.devices) if d['site'] == site_id], query)
+
+        if kind == 'devices':
+            device = self.devices[resource_id]
+            return 200, self.resource({'self': {'href': self.href('devices', resource_id)},
+                    'ch:site': {'href': self.href('sites', device['site'])},
+                    'ch:sensors': {'href': self.href('sensors', device_id=resource_id)}},
+                    name=device['name'], geoLocation=device['geoLocation'])
+
+        if kind == 'sensors' and resource_id is None:
+            device_id = int(query['device_id'])
+            return 200, self.collection('sensors', [(i, s['title']) for i, s
+                    in enumerate(self.sensors) if s['device'] == device_id], query)
+
+        if kind == 'sensors':
+            sensor = self.sensors[resource_id]
+            return 200, self.resource({'self': {'href': self.href('sensors', resource_id)},
+                    'ch:device': {'href': self.href('devices', sensor['device'])},
+                    'ch:dataHistory': {'href': self.href('scalar_data',
+                        sensor_id=resource_id)}},
+                    sensor_type=sensor['sensor_type'], metric=sensor['metric'],
+                    unit=sensor['unit'], title=sensor['title'])
+
+        if kind == 'scalar_data':
+            return 200, self.data_page(query)
+
+        raise KeyError(kind)
+
+
+    def data_page(self, query):
+        '''one page of a sensor's data, filtered by timestamp__gte/__lt (epoch
+        seconds) like ChainAPI, with a next link to the following page'''
+
+        sensor_id = int(query['sensor_id'])
+        sensor = self.sensors[sensor_id]
+        times = sensor['times']
+
+        first = 0
+        last = len(times)
+        if 'timestamp__gte' in query:
+            first = bisect.bisect_left(times, float(query['timestamp__gte']))
+        if 'timestamp__lt' in query:
+            last = bisect.bisect_left(times, float(query['timestamp__lt']))
+
+        offset = first + int(query.get('offset', 0))
+        end = min(last, offset + PAGE_SIZE)
+
+        links = {'self': {'href': self.href('scalar_data', **query)},
+                'createForm': {'href': self.href('scalar_data', sensor_id=sensor_id),
+                'title': 'Add Data'}}
+        if end < last:
+            following = dict(query, offset=end - first)
+            links['next'] = {'href': self.href('scalar_data', **following)}
+
+        return self.resource(links, data=sensor['data'][offset:end],
+                totalCount=last - first)
+
+
+    def post(self, parts, query, body):
+
+        if parts[0] == 'sensors':
+            device_id = int(query['device_id'])
+            for i, sensor in enumerate(self.sensors):
+                if (sensor['device'] == device_id and
+                        sensor['sensor_type'] == body.get('sensor_type') and
+                        sensor['metric'] == body.get('metric') and
+                        sensor['unit'] == body.get('unit')):
+                    return 200, self.get(['sensors', i], {})[1]
+
+            sensor_id = self.add_sensor(device_id, body)
+            with self.lock:
+                self.posts['sensors'] += 1
+            return 201, self.get(['sensors', sensor_id], {})[1]
+
+        if parts[0] == 'scalar_data':
+            sensor = self.sensors[int(query['sensor_id'])]
+            points = body if isinstance(body, list) else [body]
+            with self.lock:
+                for p in points:
+                    t = epoch_seconds(p['timestamp'])
+                    i = bisect.bisect_right(sensor['times'], t)
+                    sensor['times'].insert(i, t)
+                    sensor['data'].insert(i, p)
+                self.posts['data'] += len(points)
+            return 201, {'count': len(points)}
+
+        raise KeyError(parts[0])
+
+
+if __name__ == '__main__':
+    import time
+    import syntheticData
+
+    api = fakeChainApi(syntheticData.chain_graph(20, mobile_every=3)).start()
+    print 'serving %s sensors on %s' % (len(api.sensors), api.url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        api.stop()
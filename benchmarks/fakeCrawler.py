@@ -0,0 +1,41 @@
+#!/usr/bin/python
+
+'''a stand-in for the chainCrawler process: PUSHes a fixed list of sensor uris
+over zmq the way crawl_zmq does, so the workers can be benchmarked without
+crawling'''
+
+import threading
+import zmq
+
+
+class fakeCrawler(object):
+    '''bind a PUSH socket on socket and send every uri in uris, repeat times,
+    from a background thread'''
+
+    def __init__(self, socket, uris, repeat=1):
+        self.socket = socket
+        self.uris = list(uris)
+        self.repeat = repeat
+        self.sent = 0
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def run(self):
+        context = zmq.Context()
+        zmqSend = context.socket(zmq.PUSH)
+        zmqSend.bind(self.socket)
+
+        for _ in range(self.repeat):
+            for uri in self.uris:
+                zmqSend.send_string(uri)
+                self.sent += 1
+
+        zmqSend.close(linger=-1)
+        context.term()
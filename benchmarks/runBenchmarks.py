@@ -0,0 +1,314 @@
+#!/usr/bin/python
+
+'''time the processor's hot paths on synthetic data and write the results as
+json, or compare two result files.
+
+    python benchmarks/runBenchmarks.py run --sizes 1000,10000 -o new.json
+    python benchmarks/runBenchmarks.py compare old.json new.json
+
+run uses an in-memory mongomock database by default; --mongo host:port
+benchmarks against a real mongod instead (everything is written to the
+learnair_bench database, which is dropped afterwards).  mongomock scans
+every document for each query, so it runs smaller sizes by default and caps
+them lower, see SIZES and MAX_SIZES.  The end_to_end
+benchmark serves the synthetic sensors from fakeChainApi, pushes their uris
+from fakeCrawler through a broker process and times main_spawn until every
+sensor's result is in the publish queue.'''
+
+import argparse
+import multiprocessing
+import threading
+import platform
+import subprocess
+import tempfile
+import datetime
+import random
+import shutil
+import time
+import json
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lib import mongoConnection
+from lib.machineLearnDatastore import machineLearnMongo
+import syntheticData
+
+
+BENCH_DB = 'learnair_bench'
+
+#every benchmark, in the order they run
+BENCHMARKS = ['add_data_to_collection', 'add_data_to_collection_per_doc',
+        'get_values_in_range', 'return_ml_array', 'return_ml_array_in_memory',
+        'make_dt', 'end_to_end']
+
+#default --sizes per backend
+SIZES = {'mongomock': '100,1000', 'mongod': '1000,10000,100000'}
+
+#per-document upserts and per-measurement lookups are slow by design, cap them
+#per backend; mongomock's linear scans make every lookup slow
+MAX_SIZES = {
+    'mongomock': {'add_data_to_collection_per_doc': 1000, 'get_values_in_range': 100,
+            'return_ml_array': 1000, 'end_to_end': 1000},
+    'mongod': {'add_data_to_collection_per_doc': 10000, 'return_ml_array': 10000}}
+
+#lookups timed by get_values_in_range
+QUERIES = 1000
+
+
+def backend(mongo):
+    return 'mongomock' if mongo == 'mongomock' else 'mongod'
+
+
+def configure_mongo(mongo):
+    if mongo == 'mongomock':
+        import mongomock
+        mongoConnection.configure(client_factory=mongomock.MongoClient)
+    else:
+        host, _, port = mongo.partition(':')
+        mongoConnection.configure(host=host, port=int(port or 27017))
+
+
+def fresh_datastore():
+    '''a machineLearnMongo on an empty benchmark database (which also
+    clears the benchmark's sensor watermarks)'''
+    mongo = machineLearnMongo(db=BENCH_DB)
+    for name in mongo.db.collection_names():
+        mongo.drop_collection(name)
+    return machineLearnMongo(db=BENCH_DB)
+
+
+#each bench_<name>(size, repeat) returns (seconds of each run, items per run)
+
+def measure(run, setup=None, repeat=3):
+    '''seconds taken by run(*setup()) in each of repeat runs'''
+
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.time()
+        run(*args)
+        times.append(time.time() - start)
+    return times
+
+
+def bench_add_data_to_collection(size, repeat):
+    data = syntheticData.conditions(size)
+    return measure(lambda mongo, docs: mongo.add_data_to_collection('bench', docs, 1000),
+            lambda: (fresh_datastore(), [dict(d) for d in data]), repeat), size
+
+
+def bench_add_data_to_collection_per_doc(size, repeat):
+    data = syntheticData.conditions(size)
+    return measure(lambda mongo, docs: mongo.add_data_to_collection('bench', docs),
+            lambda: (fresh_datastore(), [dict(d) for d in data]), repeat), size
+
+
+def bench_get_values_in_range(size, repeat):
+    mongo = fresh_datastore()
+    mongo.add_conditions(syntheticData.conditions(size), 1000)
+
+    points = syntheticData.measurements(QUERIES, sites=10, seed=size)
+    span = size // 10 * 60
+    for p in points:
+        p['timestamp'] = syntheticData.START + datetime.timedelta(
+                seconds=random.Random(p['no2_raw']).uniform(0, span))
+
+    def run():
+        for p in points:
+            mongo.get_values_in_range('conditions', p['timestamp'], p['lat'], p['lon'])
+
+    return measure(run, repeat=repeat), QUERIES
+
+
+def ml_array_datastore(size):
+    mongo = fresh_datastore()
+    mongo.add_conditions(syntheticData.conditions(size), 1000)
+    mongo.add_data_to_collection('bench_measure',
+            syntheticData.measurements(size // 10), 1000)
+    return mongo
+
+
+def bench_return_ml_array(size, repeat):
+    mongo = ml_array_datastore(size)
+    return measure(lambda: mongo.return_ml_array('bench_measure',
+            update_conditions_first=False), repeat=repeat), size // 10
+
+
+def bench_return_ml_array_in_memory(size, repeat):
+    mongo = ml_array_datastore(size)
+    return measure(lambda: mongo.return_ml_array('bench_measure',
+            update_conditions_first=False, in_memory_join=True), repeat=repeat), size // 10
+
+
+def bench_make_dt(size, repeat):
+    strings = syntheticData.timestamp_strings(size)
+    return measure(lambda: [machineLearnMongo.make_dt(s) for s in strings],
+            repeat=repeat), size
+
+
+def bench_end_to_end(size, repeat, crawler_socket='tcp://127.0.0.1:5598',
+        workers_socket='tcp://127.0.0.1:5599', timeout=600):
+    '''size sensors (100 points each, every 4th device mobile) through
+    main_spawn; the time until every sensor's result is queued'''
+
+    import chainProcessor
+    from lib.publishQueue import publishQueue
+    from fakeChainApi import fakeChainApi
+    from fakeCrawler import fakeCrawler
+
+    api = fakeChainApi(syntheticData.chain_graph(size, mobile_every=4)).start()
+    uris = api.sensor_uris('AlphasenseAFEtemp')
+    times = []
+
+    try:
+        for _ in range(repeat):
+            fresh_datastore()
+            tmp = tempfile.mkdtemp()
+            outbox_path = os.path.join(tmp, 'publish_queue.db')
+            outbox = publishQueue(outbox_path)
+            stop = threading.Event()
+            broker_stop = multiprocessing.Event()
+            done = []
+
+            def watch():
+                while not stop.is_set():
+                    if len(outbox) >= len(uris) or time.time() - start > timeout:
+                        done.append(time.time())
+                        stop.set()
+                    time.sleep(0.01)
+
+            broker = chainProcessor.create_broker_process(crawler_socket,
+                    workers_socket, os.path.join(tmp, 'broker_state.db'), broker_stop)
+            broker.start()
+
+            start = time.time()
+            fakeCrawler(crawler_socket, uris).start()
+            threading.Thread(target=watch).start()
+            chainProcessor.main_spawn(workers_socket, stop, full_resync=True,
+                    outbox_path=outbox_path,
+                    raw_cache_path=os.path.join(tmp, 'raw_cache'), db=BENCH_DB)
+
+            broker_stop.set()
+            broker.join()
+
+            if len(outbox) < len(uris):
+                print 'end_to_end: only %s of %s sensors processed' % (len(outbox), len(uris))
+            times.append(done[0] - start)
+
+            outbox.close()
+            shutil.rmtree(tmp)
+    finally:
+        api.stop()
+
+    return times, len(uris)
+
+
+def run(args):
+
+    configure_mongo(args.mongo)
+    sizes = [int(s) for s in (args.sizes or SIZES[backend(args.mongo)]).split(',')]
+    names = args.only.split(',') if args.only else BENCHMARKS
+    max_sizes = MAX_SIZES[backend(args.mongo)]
+    results = []
+
+    for name in names:
+        for size in sizes:
+            if size > max_sizes.get(name, size):
+                print '%-32s %8d  skipped, over %s on %s' % (name, size,
+                        max_sizes[name], backend(args.mongo))
+                continue
+
+            seconds, items = globals()['bench_' + name](size, args.repeat)
+            best = min(seconds)
+            result = {'name': name, 'size': size, 'items': items,
+                    'repeat': args.repeat, 'min': best,
+                    'median': sorted(seconds)[len(seconds) // 2],
+                    'mean': sum(seconds) / len(seconds),
+                    'per_second': items / best if best else None}
+            results.append(result)
+            print '%-32s %8d  min %9.4fs  %12.1f/s' % (name, size, best,
+                    result['per_second'] or 0)
+
+    mongoConnection.get_client().drop_database(BENCH_DB)
+
+    output = {'meta': {'created': datetime.datetime.utcnow().isoformat() + 'Z',
+            'commit': git_commit(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'mongo': args.mongo},
+            'results': results}
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print 'wrote %s' % args.output
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(args):
+    '''print min time ratios (new / base) per benchmark and size; exits 1 if
+    anything got slower than threshold'''
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    base_results = dict(((r['name'], r['size']), r) for r in base['results'])
+    regressions = 0
+
+    print '%-32s %8s %11s %11s %7s' % ('benchmark', 'size', 'base', 'new', 'ratio')
+    for r in new['results']:
+        old = base_results.get((r['name'], r['size']))
+        if old is None or not old['min']:
+            continue
+
+        ratio = r['min'] / old['min']
+        flag = ''
+        if ratio > args.threshold:
+            flag = '  SLOWER'
+            regressions += 1
+        elif ratio < 1 / args.threshold:
+            flag = '  faster'
+
+        print '%-32s %8d %10.4fs %10.4fs %6.2fx%s' % (r['name'], r['size'],
+                old['min'], r['min'], ratio, flag)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--sizes',
+            help='comma separated, default %s on mongomock and %s on a mongod'
+            % (SIZES['mongomock'], SIZES['mongod']))
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--only', help='comma separated benchmark names')
+    run_parser.add_argument('--mongo', default='mongomock',
+            help='mongomock (default) or host:port of a mongod')
+    run_parser.add_argument('-o', '--output', default='benchmark_results.json')
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=1.1,
+            help='ratio above which a benchmark counts as slower')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+'''synthetic sensors, conditions and mobile tracks for the benchmarks.  Every
+generator takes a seed so runs being compared use identical data.'''
+
+import datetime
+import random
+import math
+
+
+START = datetime.datetime(2016, 1, 1)
+
+#roughly the MIT campus, the origin of every synthetic site and track
+ORIGIN = (42.3601, -71.0942)
+
+
+def site_location(site, spread=0.5):
+    '''lat, lon of synthetic site number site, within spread degrees of ORIGIN'''
+    rng = random.Random(site)
+    return (ORIGIN[0] + rng.uniform(-spread, spread),
+            ORIGIN[1] + rng.uniform(-spread, spread))
+
+
+def conditions(n, start=START, interval=60, sites=10, seed=0):
+    '''n condition documents as machineLearnMongo stores them: round robin over
+    sites, one reading per site every interval seconds'''
+
+    rng = random.Random(seed)
+    docs = []
+
+    for i in xrange(n):
+        lat, lon = site_location(i % sites)
+        docs.append({'timestamp': start + datetime.timedelta(seconds=(i // sites) * interval),
+                'lat': lat, 'lon': lon,
+                'temperature': 20 + 5 * math.sin(i / 500.0) + rng.gauss(0, 0.5),
+                'humidity': 50 + rng.gauss(0, 5),
+                'pm25': abs(rng.gauss(12, 4))})
+
+    return docs
+
+
+def measurements(n, start=START, interval=60, sites=10, jitter=10, seed=1):
+    '''n measurement documents near the condition readings of conditions(),
+    with timestamps up to jitter seconds off'''
+
+    rng = random.Random(seed)
+    docs = []
+
+    for i in xrange(n):
+        lat, lon = site_location(i % sites)
+        offset = (i // sites) * interval + rng.uniform(-jitter, jitter)
+        docs.append({'timestamp': start + datetime.timedelta(seconds=offset),
+                'lat': lat + rng.uniform(-0.001, 0.001),
+                'lon': lon + rng.uniform(-0.001, 0.001),
+                'no2_raw': abs(rng.gauss(300, 40))})
+
+    return docs
+
+
+def sensor_points(n, start=START, interval=60, seed=2):
+    '''n ChainAPI datapoints, {'timestamp': ISO 8601 string, 'value': x}'''
+
+    rng = random.Random(seed)
+    return [{'timestamp': (start + datetime.timedelta(seconds=i * interval)
+            ).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'value': rng.gauss(300, 40)} for i in xrange(n)]
+
+
+def mobile_track(n, start=START, interval=10, origin=ORIGIN, seed=3):
+    '''a random walk of n position fixes, as the (latitude, longitude,
+    elevation) datapoint lists a mobile device's position sensors hold'''
+
+    rng = random.Random(seed)
+    lat, lon, elevation = origin[0], origin[1], 10.0
+    lats, lons, elevations = [], [], []
+
+    for i in xrange(n):
+        stamp = (start + datetime.timedelta(seconds=i * interval)
+                ).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        lat += rng.gauss(0, 0.0001)
+        lon += rng.gauss(0, 0.0001)
+        elevation = max(0, elevation + rng.gauss(0, 0.2))
+        lats.append({'timestamp': stamp, 'value': lat})
+        lons.append({'timestamp': stamp, 'value': lon})
+        elevations.append({'timestamp': stamp, 'value': elevation})
+
+    return lats, lons, elevations
+
+
+def timestamp_strings(n, seed=4):
+    '''n timestamps in the mix of formats seen in ChainAPI data'''
+
+    rng = random.Random(seed)
+    formats = ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ',
+            '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f+00:00']
+    results = []
+
+    for i in xrange(n):
+        stamp = START + datetime.timedelta(seconds=rng.randint(0, 86400 * 365))
+        results.append(stamp.strftime(rng.choice(formats)))
+
+    return results
+
+
+def chain_graph(sensors, points_per_sensor=100, sensors_per_device=4,
+        devices_per_site=5, mobile_every=0, sensor_type='AlphasenseAFEtemp',
+        metric='temperature_raw', unit='raw', seed=5):
+    '''a ChainAPI site/device/sensor tree holding sensors sensors of
+    sensor_type/metric/unit, for fakeChainApi.  With mobile_every, every
+    mobile_every-th device is mobile: it sits on a site without a
+    geoLocation and has latitude/longitude/elevation sensors covering its
+    data.'''
+
+    graph = {'sites': []}
+    fixed_site = None
+    mobile_site = None
+    device = None
+
+    for i in xrange(sensors):
+
+        if i % sensors_per_device == 0:
+            number = i // sensors_per_device
+            mobile = mobile_every and number % mobile_every == mobile_every - 1
+
+            if mobile:
+                if mobile_site is None:
+                    mobile_site = {'name': 'mobile site', 'geoLocation': None, 'devices': []}
+                    graph['sites'].append(mobile_site)
+                site = mobile_site
+            else:
+                if fixed_site is None or len(fixed_site['devices']) >= devices_per_site:
+                    lat, lon = site_location(len(graph['sites']))
+                    fixed_site = {'name': 'site %s' % len(graph['sites']),
+                            'geoLocation': {'latitude': lat, 'longitude': lon,
+                            'elevation': 10.0}, 'devices': []}
+                    graph['sites'].append(fixed_site)
+                site = fixed_site
+
+            device = {'name': 'device %s' % number, 'geoLocation': None, 'sensors': []}
+            site['devices'].append(device)
+
+            if mobile:
+                lats, lons, elevations = mobile_track(points_per_sensor * 6 + 1,
+                        seed=seed + number)
+                for title, points in (('latitude', lats), ('longitude', lons),
+                        ('elevation', elevations)):
+                    device['sensors'].append({'sensor_type': 'gps', 'metric': title,
+                            'unit': 'degrees', 'title': title, 'data': points})
+
+        device['sensors'].append({'sensor_type': sensor_type, 'metric': metric,
+                'unit': unit, 'title': metric,
+                'data': sensor_points(points_per_sensor, seed=seed + i)})
+
+    return graph
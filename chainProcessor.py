@@ -1,13 +1,29 @@
 #!/usr/bin/python
 
-from lib.processes import *
+from lib.processRegistry import processRegistry
+from lib.chainHttp import get_client
+from lib.machineLearnDatastore import sensorWatermarkMongo, utc_naive
+from lib.timestampNormalizer import default_normalizer as normalize
+from lib.uriBroker import uriBroker, BROKER_PATH
+from lib.publishQueue import publishQueue, QUEUE_PATH
+from lib.geotag import stationaryLocation, locationTrack, geolocation, point_seconds
+from lib import trainingScheduler
+from lib import metrics
+from lib.chainHalCrawler import chainHalCrawler
+from lib.topologyIndex import get_index as topology
+from lib.rawDataCache import rawDataCache, RAW_CACHE_PATH
+import numpy as np
 import zmq
 import sys
-import requests
 import json
-import pkgutil
+import datetime
+import signal
+import time
+import os
 import logging
-from multiprocessing import Process
+from multiprocessing import Process, Event, Queue, Manager, cpu_count
+from Queue import Empty
+from collections import OrderedDict, deque
 from chaincrawler import chainCrawler, chainSearch
 from chainlearnairdata import chainTraversal
 
@@ -20,6 +36,22 @@ ch = logging.StreamHandler()
 ch.setLevel(logging.INFO)
 log.addHandler(ch)
 
+#seconds a device/aux search result is reused before searching again
+SEARCH_TTL = 3600
+
+#seconds a search that found nothing is remembered, shorter so a new
+#resource is picked up sooner
+SEARCH_MISS_TTL = 300
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#seconds between a datapoint and a mobile device's position fix for the fix
+#to be used as the datapoint's geotag
+GEOTAG_TOLERANCE = 60
+
+#titles of the sensors that hold a mobile device's position track
+TRACK_TITLES = {'lat': 'latitude', 'lon': 'longitude', 'elevation': 'elevation'}
+
 
 ##
 #CREATE CRAWLER PROCESS THAT SEARCHES FOR SENSORS AND PUSHES THEM OVER ZMQ
@@ -32,10 +64,9 @@ def create_crawler_process(socket="tcp://127.0.0.1:5557",
 
 
 def crawler_spawn(socket, namespace, criteria):
-    #TODO: currently the crawler only supports finding one type of object
-    # it would be great to pass a list of objects we'd like to find instead of
-    # crawling for one particular type.
-    # Instead of just crawling for sensors, crawl for list of process names
+    #chainCrawler only supports finding one type of object per crawl; to find
+    #the sensors of every process in lib/processes in one traversal, spread
+    #over several processes, use create_crawler_pool_process instead
 
     crawler = chainCrawler.ChainCrawler(entry_point='http://learnair.media.mit.edu:8000/sites/3')
 
@@ -45,143 +76,852 @@ def crawler_spawn(socket, namespace, criteria):
         crawler.crawl_zmq(socket=socket, namespace=namespace, resource_type='Sensor')
 
 
+##
+#CREATE CRAWLER POOL THAT FINDS THE SENSORS OF EVERY REGISTERED PROCESS IN ONE
+#TRAVERSAL, SPLIT ACROSS SEVERAL CRAWLER PROCESSES
+##
+
+def create_crawler_pool_process(socket="tcp://127.0.0.1:5557",
+        entry_points=('http://learnair.media.mit.edu:8000/sites/3',), processes=4,
+        interval=600, stop=None):
+
+    return Process(target=crawler_pool_spawn, args=(socket, list(entry_points),
+            processes, interval, stop))
+
+
+def crawler_pool_spawn(socket, entry_points, processes=4, interval=600, stop=None):
+    '''crawl from entry_points every interval seconds, PUSHing (connected to
+    socket) the uri of every sensor whose sensor_type has a process in the
+    registry.  Each crawl first expands the graph until there are a few
+    subtrees per crawler process, then the processes take subtrees from a
+    shared queue and crawl them, skipping anything another process already
+    visited this cycle (a Manager dict keyed by (cycle, uri)).  Every sensor
+    crawled is recorded in the topology index, and sensors that have not
+    been seen for a day are dropped from it.'''
+
+    if stop is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    registry = processRegistry()
+    visited = Manager().dict()
+
+    context = zmq.Context()
+    zmqSend = context.socket(zmq.PUSH)
+    zmqSend.connect(socket)
+
+    metrics.start('crawler')
+    cycle = 0
+
+    while stop is None or not stop.is_set():
+
+        start = time.time()
+        registry.scan()
+        visited.clear()
+
+        splitter = chainHalCrawler(lambda sensor_type: registry.find(sensor_type) is not None,
+                zmqSend.send_string, visited, cycle, topology=topology())
+        shards = splitter.split(entry_points, processes * 4)
+
+        work = Queue()
+        for uri in shards:
+            work.put(uri)
+
+        pool = [Process(target=crawler_shard_spawn, args=(socket, work, visited,
+                cycle, stop)) for _ in range(min(processes, len(shards)))]
+        for p in pool:
+            p.start()
+        for p in pool:
+            p.join()
+
+        try:
+            topology().prune()
+        except Exception:
+            log.exception('could not prune the topology index')
+
+        metrics.increment('crawler.cycles')
+        metrics.observe('crawler.cycle', time.time() - start)
+        log.info('crawl %s over %s subtrees took %.1fs', cycle, len(shards),
+                time.time() - start)
+        cycle += 1
+
+        while time.time() - start < interval and (stop is None or not stop.is_set()):
+            time.sleep(1)
+
+    zmqSend.close()
+    context.term()
+
+
+def crawler_shard_spawn(socket, work, visited, cycle, stop=None):
+    '''crawl subtrees taken from the work queue until it is empty'''
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    registry = processRegistry()
+
+    context = zmq.Context()
+    zmqSend = context.socket(zmq.PUSH)
+    zmqSend.connect(socket)
+
+    crawler = chainHalCrawler(lambda sensor_type: registry.find(sensor_type) is not None,
+            zmqSend.send_string, visited, cycle, topology=topology())
+
+    while stop is None or not stop.is_set():
+        try:
+            entry_point = work.get(timeout=1)
+        except Empty:
+            break
+        crawler.crawl([entry_point])
+
+    log.info('crawler %s found %s sensors in %s resources', os.getpid(),
+            crawler.found, len(crawler.seen))
+
+    zmqSend.close(linger=-1)
+    context.term()
+
+
+##
+#CREATE BROKER PROCESS THAT QUEUES URIS FROM THE CRAWLER BY PRIORITY, HANDS THEM
+#TO IDLE WORKERS AND REDELIVERS ANY A WORKER DOES NOT ACKNOWLEDGE
+##
+
+def create_broker_process(in_socket="tcp://127.0.0.1:5557",
+        out_socket="tcp://127.0.0.1:5558", path=BROKER_PATH, stop=None,
+        bind_crawler=False, **options):
+
+    return Process(target=broker_spawn, args=(in_socket, out_socket, path, stop,
+            bind_crawler), kwargs=options)
+
+
+def broker_spawn(in_socket, out_socket, path=BROKER_PATH, stop=None, bind_crawler=False,
+        **options):
+    '''PULL uris from the crawler on in_socket into a uriBroker (state kept
+    in path, options are uriBroker's) and hand them out on the ROUTER
+    out_socket, most overdue first, one per 'ready' request from a worker.
+    Workers 'ack' each uri with the number of new datapoints it had.
+
+    While max_queue uris are waiting the crawler socket is not read, so the
+    crawler blocks on its send high-water mark instead of filling memory.
+    bind_crawler binds in_socket for crawlers that connect to it (the
+    crawler pool) instead of connecting to a crawler that binds.'''
+
+    if stop is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    broker = uriBroker(path, **options)
+    metrics.start('broker')
+
+    context = zmq.Context()
+    zmqReceive = context.socket(zmq.PULL)
+    #only a little buffered here, the rest waits at the crawler
+    zmqReceive.setsockopt(zmq.RCVHWM, 100)
+    if bind_crawler:
+        zmqReceive.bind(in_socket)
+    else:
+        zmqReceive.connect(in_socket)
+    zmqWorkers = context.socket(zmq.ROUTER)
+    zmqWorkers.bind(out_socket)
+
+    accepting = zmq.Poller()
+    accepting.register(zmqReceive, zmq.POLLIN)
+    accepting.register(zmqWorkers, zmq.POLLIN)
+    full = zmq.Poller()
+    full.register(zmqWorkers, zmq.POLLIN)
+
+    idle = deque()  #identities of workers waiting for a uri
+    last_expire = time.time()
+
+    while stop is None or not stop.is_set():
+
+        #sleep until the next uri is due, but wake up regularly
+        timeout = 1000
+        due = broker.next_time()
+        if idle and due is not None:
+            timeout = max(0, min(timeout, int((due - time.time()) * 1000)))
+
+        poller = full if broker.full() else accepting
+        events = dict(poller.poll(timeout))
+
+        if zmqWorkers in events:
+            frames = zmqWorkers.recv_multipart()
+            worker, command = frames[0], frames[1]
+
+            if command == 'ready':
+                idle.append(worker)
+            elif command == 'ack':
+                broker.ack(frames[2].decode('utf-8'), int(frames[3]))
+                metrics.increment('broker.acked')
+            elif command == 'bye' and worker in idle:
+                idle.remove(worker)
+
+        if zmqReceive in events:
+            if broker.offer(zmqReceive.recv_string()):
+                metrics.increment('broker.queued')
+            else:
+                metrics.increment('broker.duplicates')
+
+        if time.time() - last_expire > 10:
+            metrics.increment('broker.redelivered', len(broker.expire()))
+            last_expire = time.time()
+
+        while idle:
+            uri = broker.pop()
+            if uri is None:
+                break
+            zmqWorkers.send_multipart([idle.popleft(), uri.encode('utf-8')])
+            metrics.increment('broker.dispatched')
+
+        metrics.gauge('broker.queued', len(broker))
+        metrics.gauge('broker.inflight', len(broker.inflight))
+
+    broker.close()
+    zmqReceive.close()
+    zmqWorkers.close()
+    context.term()
+    log.info('broker stopped')
+
+
+##
+#CREATE UPLOADER PROCESS THAT POSTS QUEUED VIRTUAL SENSOR DATA TO CHAINAPI, SO
+#PROCESSING NEVER WAITS ON CHAINAPI WRITES
+##
+
+def create_uploader_process(path=QUEUE_PATH, stop=None, batch_size=500, poll_interval=1):
+    return Process(target=uploader_spawn, args=(path, stop, batch_size, poll_interval))
+
+
+def uploader_spawn(path=QUEUE_PATH, stop=None, batch_size=500, poll_interval=1):
+    '''post the entries of the publish queue at path as they become due.
+    Entries for the same virtual sensor (source uri, sensor_type, metric,
+    unit) are posted in one safe_add_data call and acked together; if the
+    post fails they are retried with backoff.  Whatever is left when stop is
+    set stays queued for the next run.'''
+
+    if stop is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    outbox = publishQueue(path)
+    metrics.start('uploader')
+    log.info('uploader started, %s entries queued', len(outbox))
+
+    while stop is None or not stop.is_set():
+
+        entries = outbox.due(batch_size)
+        if not entries:
+            time.sleep(poll_interval)
+            continue
+
+        #group entries per virtual sensor, oldest first
+        groups = OrderedDict()
+        for entry in entries:
+            key = (entry['uri'], entry['sensor_type'], entry['metric'], entry['unit'])
+            groups.setdefault(key, []).append(entry)
+
+        for key, group in groups.iteritems():
+            data = []
+            for entry in group:
+                if isinstance(entry['data'], list):
+                    data.extend(entry['data'])
+                elif entry['data'] is not None:
+                    data.append(entry['data'])
+
+            ids = [entry['id'] for entry in group]
+            try:
+                with metrics.timer('stage.upload'):
+                    upload(*key, data=data or None)
+                outbox.ack(ids)
+                metrics.increment('publish.uploaded', len(data))
+                log.info('published %s points to %s %s on %s', len(data), key[2],
+                        key[3], key[0])
+            except Exception:
+                metrics.increment('publish.failed', len(ids))
+                log.exception('publishing to %s %s on %s failed, will retry',
+                        key[2], key[3], key[0])
+                outbox.retry(ids)
+
+    outbox.close()
+    log.info('uploader stopped')
+
+
 ##
 #CREATE MAIN PROCESS THAT RECEIVES SENSOR URIS, CHECKS THEM AGAINST THE PROCESSES
 #WE HAVE TO RUN, SENDS DATA TO SECONDARY PROCESS, AND PUBLISHES DATA FROM SECONDARY
 #PROCESS TO 'VIRTUAL' SENSORS
 ##
 
-def create_main_process(socket="tcp://127.0.0.1:5557"):
-    return Process(target=main_spawn, args=(socket,))
+def create_main_process(socket="tcp://127.0.0.1:5557", workers=1, full_resync=False,
+        outbox_path=QUEUE_PATH, raw_cache_path=RAW_CACHE_PATH):
+    return Process(target=main_pool_spawn, args=(socket, workers, full_resync,
+            outbox_path, raw_cache_path))
+
+
+def main_pool_spawn(socket, workers, full_resync=False, outbox_path=QUEUE_PATH,
+        raw_cache_path=RAW_CACHE_PATH):
+    '''start a pool of worker processes that all PULL sensor uris from socket
+    (zmq spreads the uris across them).  SIGTERM/SIGINT to this process ask
+    every worker to finish the uri it is working on and exit.  full_resync
+    makes the workers ignore the stored per-sensor high-water marks and
+    fetch every sensor's whole history again.  Model retraining is handed
+    to a separate training process shared by all workers.  Each worker
+    queues its results in the publish queue at outbox_path, which one
+    uploader process posts to ChainAPI.  The raw data the workers download is kept in
+    the raw data cache at raw_cache_path (None keeps nothing).  If metrics
+    are configured (lib/metrics.py) this process serves every process's
+    stats over http.'''
+
+    metrics.serve()
+
+    stop = Event()
+    training_queue = Queue()
+
+    pool = [trainingScheduler.create_training_process(training_queue, stop),
+            create_uploader_process(outbox_path, stop)]
+    pool += [Process(target=main_spawn, args=(socket, stop, worker, full_resync,
+            training_queue, outbox_path, raw_cache_path))
+            for worker in range(workers)]
+
+    for p in pool:
+        p.start()
+
+    def shutdown(signum, frame):
+        log.info('shutting down %s workers', workers)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while any(p.is_alive() for p in pool):
+        for p in pool:
+            p.join(1)
 
+    log.info('all workers stopped')
 
-def main_spawn(socket):
 
-    #get list of names of processes (should be names of sensors we're interested in)
-    processes = [name for _, name, _ in pkgutil.iter_modules(['lib/processes'])]
+def main_spawn(socket, stop=None, worker=0, full_resync=False, training_queue=None,
+        outbox_path=QUEUE_PATH, raw_cache_path=RAW_CACHE_PATH, db='learnair'):
+    '''worker loop: ask the broker on socket for a sensor uri, fetch and
+    process its data, write the result to the publish queue at outbox_path
+    (None publishes inline) and ack the uri to the broker with its count of
+    new datapoints.  Downloaded data is appended to the raw data cache at
+    raw_cache_path.  Sensor watermarks are kept in the mongo database db.'''
+
+    #the pool supervisor handles ctrl-c; SIGTERM finishes the current uri
+    if stop is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    #retrain models in the background instead of in the middle of a uri
+    if training_queue is not None:
+        trainingScheduler.set_queue(training_queue)
+
+    #index of processes (named after the sensor types we're interested in)
+    registry = processRegistry()
 
     context = zmq.Context()
-    zmqReceive = context.socket(zmq.PULL)
-    zmqReceive.connect(socket)
+    zmqBroker = context.socket(zmq.DEALER)
+    zmqBroker.connect(socket)
+
+    poller = zmq.Poller()
+    poller.register(zmqBroker, zmq.POLLIN)
+
+    def ack(uri, item=None):
+        points = len(item['data'][0]['main']) if item is not None else 0
+        zmqBroker.send_multipart(['ack', uri.encode('utf-8'), str(points)])
 
-    while(1):
+    watermarks = sensorWatermarkMongo(db)
+    outbox = publishQueue(outbox_path) if outbox_path is not None else None
+    raw_cache = rawDataCache(raw_cache_path) if raw_cache_path is not None else None
 
-        uri = zmqReceive.recv_string()
+    metrics.start('worker-%s' % worker)
+    profile = metrics.profiler()
 
-        #retrieve uri, put into json
-        res_json = get_json_from_uri(uri)
+    log.info('worker %s started', worker)
+    zmqBroker.send('ready')
+
+    while stop is None or not stop.is_set():
 
-        #check if sensor_type matches a process
-        process = check_sensor_type_has_process(res_json, processes)
+        #wake up every second to check for shutdown
+        if poller.poll(1000):
+            uri = zmqBroker.recv().decode('utf-8')
+            metrics.increment('uris.received')
+            item = None
+
+            try:
+                with profile(uri):
+                    with metrics.timer('stage.prepare'):
+                        item = prepare_uri(uri, registry, watermarks, full_resync,
+                                raw_cache)
+
+                    if item is None:
+                        metrics.increment('uris.skipped')
+                    else:
+                        run_item(item, watermarks, outbox)
+            except Exception:
+                metrics.increment('uris.failed')
+                log.exception('worker %s failed to process %s', worker, uri)
+            finally:
+                ack(uri, item)
+
+            #only ask for the next uri once this one is done
+            zmqBroker.send('ready')
+
+    zmqBroker.send('bye')
+
+    if outbox is not None:
+        outbox.close()
+
+    zmqBroker.close(linger=1000)
+    context.term()
+    log.info('worker %s stopped', worker)
+
+
+def process_uri(uri, registry, watermarks=None, full_resync=False, outbox=None,
+        raw_cache=None, from_cache=False):
+    '''fetch, process and publish the data of one sensor uri'''
+
+    item = prepare_uri(uri, registry, watermarks, full_resync, raw_cache, from_cache)
+    if item is not None:
+        run_item(item, watermarks, outbox)
+
+
+def reprocess_cached(uris=None, raw_cache_path=RAW_CACHE_PATH, outbox_path=QUEUE_PATH):
+    '''process (and publish) the whole cached history of uris, or of every
+    sensor in the raw data cache, reading the data from disk instead of
+    ChainAPI.  Stored watermarks are left alone.'''
+
+    registry = processRegistry()
+    raw_cache = rawDataCache(raw_cache_path)
+    outbox = publishQueue(outbox_path) if outbox_path is not None else None
+
+    for uri in uris or raw_cache.uris():
+        try:
+            process_uri(uri, registry, outbox=outbox, raw_cache=raw_cache,
+                    from_cache=True)
+        except Exception:
+            log.exception('could not reprocess %s', uri)
+
+    if outbox is not None:
+        outbox.close()
+
+
+def prepare_uri(uri, registry, watermarks=None, full_resync=False, raw_cache=None,
+        from_cache=False):
+    '''fetch and geotag the data of one sensor uri.  Returns the work item
+    for run_item, a dict with 'uri', 'process' (registry entry), 'metric',
+    'unit', 'data' and 'newest' (newest timestamp in the data), or None if
+    there is nothing to process.  With watermarks (a sensorWatermarkMongo),
+    only data newer than the sensor's stored high-water mark is fetched;
+    full_resync ignores the stored mark.  Fetched data is appended to
+    raw_cache (a rawDataCache) if given; with from_cache the data is read
+    from raw_cache instead of being downloaded, and the sensor is looked up
+    in the topology index first.'''
+
+    #retrieve uri, put into json
+    with metrics.timer('stage.get_sensor'):
+        res_json = topology().sensor(uri) if from_cache else None
+        if res_json is None:
+            res_json = get_json_from_uri(uri)
+
+    metric = get_attribute(res_json, 'metric')
+    unit = get_attribute(res_json, 'unit')
+
+    #check if sensor_type/metric/unit matches a process
+    process = check_sensor_type_has_process(res_json, registry, metric, unit)
+
+    if process is None or metric is None or unit is None:
+        return
+
+    #check if process requires extra data
+    aux_data = process['aux']
+    print 'auxdata is %s' %aux_data
+
+    since = None
+    if watermarks is not None and not full_resync:
+        since = watermarks.get(uri)
+
+    #get required data using traversal, main and aux data concurrently
+    if from_cache:
+        with metrics.timer('stage.read_cache'):
+            data = cached_sensor_data(uri, aux_data, raw_cache, since)
+    else:
+        with metrics.timer('stage.fetch_data'):
+            data = fetch_sensor_data(uri, aux_data, since)
 
-        metric = get_attribute(res_json, 'metric')
-        unit = get_attribute(res_json, 'unit')
+    if not data or 'main' not in data[0]:
+        log.warn('could not download data for %s', uri)
+        return
 
-        if process is None or metric is None or unit is None:
-            continue
+    newest = newest_timestamp(data[0]['main'])
 
-        #check if process requires extra data
-        aux_data = globals()[process].required_aux_data(metric, unit)
-        print 'auxdata is %s' %aux_data
-
-        #get required data using traversal
-        traveler = chainTraversal.ChainTraversal(entry_point=uri)
-        data = []
-        data.append({'main': traveler.get_all_data()})
-
-        if aux_data is not None:
-            searcher = chainSearch.ChainSearch(entry_point=uri)
-            for title in aux_data:
-                found = searcher.find_first(resource_title=title)
-                if found:
-                    traveler = chainTraversal.ChainTraversal(entry_point=found[0])
-                    data.append({title: traveler.get_all_data()})
-
-        #add geotag data 'lat', 'lon', 'elevation' to each datapoint
-        #we are assuming that all sensors are part of the same device/site
+    if newest is None:
+        log.info('no new data for %s', uri)
+        return
+
+    if from_cache:
+        #cached points keep the geotags they were stored with
+        return {'uri': uri, 'process': process, 'metric': metric, 'unit': unit,
+                'data': data, 'newest': newest}
+
+    #add geotag data 'lat', 'lon', 'elevation' to each datapoint
+    #we are assuming that all sensors are part of the same device/site
+    with metrics.timer('stage.add_geotags'):
         data = add_geotags(uri, data)
 
-        #call process_data on data from sensor
-        publish_vals = globals()[process].process_data(data, metric, unit)
+    if raw_cache is not None:
+        with metrics.timer('stage.write_cache'):
+            cache_sensor_data(uri, data, raw_cache)
 
-        #publish any data returned from subprocess
-        if publish_vals is not None:
-            searcher = chainSearch.ChainSearch(entry_point=uri)
-            found = searcher.find_first(resource_type='device',
-                    namespace='http://learnair.media.mit.edu:8000/rels/')
+    return {'uri': uri, 'process': process, 'metric': metric, 'unit': unit,
+            'data': data, 'newest': newest}
 
-            if found:
-                traveler = chainTraversal.ChainTraversal(entry_point=found[0])
 
-                try:
-                    traveler.add_and_move_to_resource('Sensor',
-                            {'sensor_type': publish_vals[0],
-                            'metric': publish_vals[1],
-                            'unit': publish_vals[2]} )
+def run_item(item, watermarks=None, outbox=None):
+    '''process the data of an item from prepare_uri, publish the result (to
+    outbox if given, see publish) and move the sensor's watermark forward.
+    The data goes straight to the registry entry's DISPATCH function;
+    plugins without a DISPATCH table get their process_data called.'''
 
-                    if publish_vals[3] is not None:
-                        traveler.safe_add_data(publish_vals[3])
-                except:
-                    log.warn('publish data from processor malformed')
+    process = item['process']
 
-            else:
-                log.warn("can't find device to publish data to")
+    with metrics.timer('stage.process_data'):
+        if process['function'] is not None:
+            publish_vals = process['function'](item['data'])
         else:
-            log.info('no values to publish')
+            publish_vals = process['module'].process_data(item['data'],
+                    item['metric'], item['unit'])
 
+    with metrics.timer('stage.publish'):
+        publish(item['uri'], publish_vals, outbox)
 
-def get_attribute(json, field):
+    if watermarks is not None:
+        watermarks.post(item['uri'], item['newest'])
+    metrics.increment('uris.processed')
+
+
+def publish(uri, publish_vals, outbox=None):
+    '''post a [sensor_type, metric, unit, data] result from a process as a
+    sensor on the device of the sensor at uri.  With outbox (a publishQueue)
+    the result is only queued and the uploader process posts it later,
+    otherwise it is posted right away.'''
+
+    #publish any data returned from subprocess
+    if publish_vals is None:
+        log.info('no values to publish')
+        return
+
+    sensor_type, metric, unit, data = publish_vals
+
+    if outbox is not None:
+        outbox.put(uri, sensor_type, metric, unit, data)
+    else:
+        upload(uri, sensor_type, metric, unit, data)
+
+
+def upload(uri, sensor_type, metric, unit, data):
+    '''add (or find) the virtual sensor on the device of the sensor at uri and
+    post data to it.  Raises if the device can't be found or ChainAPI
+    rejects the data.'''
+
+    device = find_device(uri)
+
+    if device is None:
+        raise LookupError("can't find device of %s to publish data to" % uri)
+
+    traveler = chainTraversal.ChainTraversal(entry_point=device)
+    traveler.add_and_move_to_resource('Sensor',
+            {'sensor_type': sensor_type, 'metric': metric, 'unit': unit})
+
+    if data is not None:
+        traveler.safe_add_data(data)
+
+
+def fetch_sensor_data(uri, aux_data, since=None):
+    '''download the data of the sensor at uri and of each aux_data title found
+    near it, concurrently on the shared http client's thread pool.  Returns
+    [{'main': data}, {title: data}, ...]; titles that can't be found are left
+    out.  If since is given only data newer than it is downloaded.'''
+
+    def fetch(title):
+        entry_point = uri
+
+        if title != 'main':
+            entry_point = find_sibling(uri, title)
+            if entry_point is None:
+                return None
+
+        if since is not None:
+            with metrics.timer('stage.get_data_since'):
+                return {title: get_data_since(entry_point, since)}
+
+        with metrics.timer('stage.get_all_data'):
+            traveler = chainTraversal.ChainTraversal(entry_point=entry_point)
+            return {title: traveler.get_all_data()}
+
+    titles = ['main'] + list(aux_data or [])
+    return [d for d in get_client().map(fetch, titles) if d is not None]
+
+
+def cache_sensor_data(uri, data, raw_cache):
+    '''append the fetched [{'main': data}, {title: data}, ...] of the sensor at
+    uri to raw_cache, each aux title under its own sensor's uri.  Never
+    raises, the cache is not worth failing a sensor for.'''
+
+    for entry in data:
+        for title, points in entry.iteritems():
+            try:
+                target = uri if title == 'main' else find_sibling(uri, title)
+                if target is not None and points:
+                    metrics.increment('cache.appended', raw_cache.append(target, points))
+            except Exception:
+                log.exception('could not cache %s data of %s', title, uri)
+
+
+def cached_sensor_data(uri, aux_data, raw_cache, since=None):
+    '''the data of the sensor at uri and its aux_data titles from raw_cache, in
+    the form fetch_sensor_data returns; only points after since if given'''
+
+    if since is not None:
+        #the cache reads timestamp >= since, we want strictly after it
+        since = np.nextafter((utc_naive(since) - EPOCH).total_seconds(), np.inf)
+
+    def read(title):
+        entry_point = uri if title == 'main' else find_sibling(uri, title)
+        if entry_point is None:
+            return None
+        points = raw_cache.points(entry_point, since=since)
+        return {title: points} if points or title == 'main' else None
+
+    titles = ['main'] + list(aux_data or [])
+    return [d for d in map(read, titles) if d is not None]
+
+
+def get_data_since(uri, since):
+    '''the datapoints of the sensor at uri with a timestamp after since,
+    read from its ch:dataHistory pages filtered server side with
+    timestamp__gte (epoch seconds) rather than walking the whole history'''
+
+    res_json = get_client().get_json(uri)
     try:
-        return json[field]
-    except:
-        return None
+        href = res_json['_links']['ch:dataHistory']['href']
+    except (KeyError, TypeError):
+        log.warn('no dataHistory for %s', uri)
+        return []
 
+    since = utc_naive(since)
+    params = {'timestamp__gte': (since - EPOCH).total_seconds()}
+    points = []
+
+    while href:
+        page = get_client().get(href, params=params).json()
+        points.extend(page.get('data', []))
+        href = page.get('_links', {}).get('next', {}).get('href')
+        params = None #the next link already carries the query
+
+    return [p for p, t in zip(points, point_times(points))
+            if t is not None and t > since]
+
+
+def newest_timestamp(points):
+    '''latest timestamp (naive UTC datetime) in a list of datapoints, or None'''
+
+    times = [t for t in point_times(points) if t is not None]
+    return max(times) if times else None
+
+
+def point_times(points):
+    '''timestamps of a list of datapoints as naive UTC datetimes (None where
+    missing), parsed as one column'''
+
+    times = normalize.parse_column([p.get('timestamp') for p in points])
+    return [utc_naive(t) if t is not None else None for t in times]
+
+
+def cached_find_first(uri, **query):
+    '''ChainSearch(entry_point=uri).find_first(**query), remembered for
+    SEARCH_TTL seconds since the graph around a sensor rarely changes (for
+    SEARCH_MISS_TTL if nothing was found)'''
+
+    def search():
+        with metrics.timer('stage.find_first'):
+            return chainSearch.ChainSearch(entry_point=uri).find_first(**query)
+
+    key = ('find_first', uri, tuple(sorted(query.items())))
+    return get_client().cache.memoize(key, search, SEARCH_TTL, SEARCH_MISS_TTL)
 
-def get_json_from_uri(uri):
+
+def find_device(uri):
+    '''uri of the device of the sensor at uri, from the topology index the
+    crawler keeps, or by searching the graph if the sensor is not indexed'''
 
     try:
-        req = requests.get(uri)
-        log.info( '%s downloaded.', uri )
-        return req.json()
+        device = topology().device(uri)
+    except Exception:
+        log.exception('topology index lookup failed for %s', uri)
+        device = None
 
-    except requests.exceptions.ConnectionError:
-        log.warn( 'URI "%s" unresponsive', uri )
-        return None
+    if device is not None:
+        metrics.increment('topology.hits')
+        return device
+
+    metrics.increment('topology.misses')
+    found = cached_find_first(uri, resource_type='device',
+            namespace='http://learnair.media.mit.edu:8000/rels/')
+    return found[0] if found else None
 
 
-def check_sensor_type_has_process(res_json, processes):
-    #return process or none if no process for this sensor exists
+def find_sibling(uri, title):
+    '''uri of the sensor titled title on the same device as the sensor at
+    uri, from the topology index, or by searching the graph if either is not
+    indexed'''
+
     try:
-        sensor_type = res_json['sensor_type']
+        sibling = topology().sibling(uri, title)
+    except Exception:
+        log.exception('topology index lookup failed for %s', uri)
+        sibling = None
+
+    if sibling is not None:
+        metrics.increment('topology.hits')
+        return sibling
 
-        for process in processes:
-            if sensor_type.lower() == process.lower():
-                log.info('sensor_type %s matches a process', process)
-                return process
+    metrics.increment('topology.misses')
+    found = cached_find_first(uri, resource_title=title)
+    return found[0] if found else None
 
-        log.info('sensor_type %s does not match any process', sensor_type)
+
+def get_attribute(json, field):
+    try:
+        return json[field]
+    except:
         return None
 
+
+def get_json_from_uri(uri):
+    return get_client().get_json(uri)
+
+
+def check_sensor_type_has_process(res_json, registry, metric, unit):
+    #return the registry entry of the process for this sensor, or none if no
+    #process handles this sensor_type/metric/unit
+    try:
+        sensor_type = res_json['sensor_type']
     except:
         log.warn('no sensor_type detected')
         return None
 
+    process = registry.lookup(sensor_type, metric, unit)
+    if process is not None:
+        log.info('sensor_type %s matches a process', process['process'])
+    return process
 
-def add_geotags(uri, data):
+
+def add_geotags(uri, data, tolerance=GEOTAG_TOLERANCE):
     '''(1) pull geotag data from device or site.  If site exists it's stationary,
     append geotag to all data.  If device it's not stationary, append geotag to
     each individual datapoint with some tolerance for timing.  If neither site
-    nor device have geotag throw an error.  uri is uri of sensor.'''
+    nor device have geotag throw an error.  uri is uri of sensor.
+
+    A stationary location is cached for SEARCH_TTL seconds, and the lack of
+    one (a mobile device) for SEARCH_MISS_TTL.  A mobile device's
+    track is read from its latitude/longitude(/elevation) sensors, only over
+    the time span of data, and matched to every datapoint in one sorted
+    (searchsorted) pass; points with no fix within tolerance seconds are left
+    untagged.'''
+
+    location = get_client().cache.memoize(('geotag', uri),
+            lambda: find_stationary_location(uri), SEARCH_TTL, SEARCH_MISS_TTL)
+
+    if location is None:
+        location = find_location_track(uri, data, tolerance)
+
+    if location is None:
+        raise LookupError('no geotag on site or device of %s' % uri)
 
+    tagged = 0
+    for entry in data:
+        for points in entry.itervalues():
+            tagged += location.tag(points)
 
+    log.debug('geotagged %s points of %s', tagged, uri)
+    return data
+
+
+def find_stationary_location(uri):
+    '''the stationaryLocation of the site of the sensor at uri, or of its device
+    if that device has no position track, or None'''
+
+    for resource_type in ('site', 'device'):
+        found = cached_find_first(uri, resource_type=resource_type,
+                namespace='http://learnair.media.mit.edu:8000/rels/')
+        if not found:
+            continue
+
+        if resource_type == 'device' and find_sibling(uri, TRACK_TITLES['lat']):
+            return None #mobile, see find_location_track
+
+        position = geolocation(get_client().get_json(found[0]))
+        if position is not None:
+            return stationaryLocation(*position)
+
+    return None
+
+
+def find_location_track(uri, data, tolerance=GEOTAG_TOLERANCE):
+    '''the locationTrack of the device of the sensor at uri covering the
+    datapoints in data, or None if the device has no position sensors'''
+
+    times = [point_seconds(points) for entry in data for points in entry.itervalues()]
+    times = np.concatenate(times) if times else np.array([])
+    times = times[~np.isnan(times)]
+    if not len(times):
+        return None
+
+    since = EPOCH + datetime.timedelta(seconds=times.min() - tolerance)
+
+    def fetch(key):
+        found = find_sibling(uri, TRACK_TITLES[key])
+        return get_data_since(found, since) if found else None
+
+    lats, lons, elevations = get_client().map(fetch, ['lat', 'lon', 'elevation'])
+    if not lats or not lons:
+        return None
+
+    return locationTrack.from_points(lats, lons, elevations, tolerance)
 
 
 if __name__=='__main__':
     socket="tcp://127.0.0.1:5557"
+    broker_socket="tcp://127.0.0.1:5558"
+
+    #per-process stats files; add http_port=... to serve them all over http
+    #and profile_threshold=... to log where slow uris spend their time
+    metrics.configure(stats_dir='metrics')
 
-    p1 = create_main_process(socket)
-    p2 = create_crawler_process(socket)
+    #the broker and crawler pool stop on this; the main pool stops its own
+    #workers on SIGTERM
+    stop = Event()
+
+    p1 = create_main_process(broker_socket, workers=cpu_count())
+    p2 = create_broker_process(socket, broker_socket, stop=stop, bind_crawler=True)
+    p3 = create_crawler_pool_process(socket, stop=stop)
 
     p1.start()
     p2.start()
+    p3.start()
+
+    def shutdown(signum, frame):
+        log.info('shutting down')
+        stop.set()
+        p1.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while any(p.is_alive() for p in (p1, p2, p3)):
+        for p in (p1, p2, p3):
+            p.join(1)
+
+    log.info('stopped')
 
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+from chainHttp import get_client
+from collections import OrderedDict
+import os
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#link relations followed while crawling: down the site/device/sensor tree and
+#through collection pages, never up to parents or into data histories
+FOLLOW_RELS = ('items', 'next', 'ch:sites', 'ch:devices', 'ch:sensors')
+
+
+class chainHalCrawler(object):
+    '''breadth first crawl of ChainAPI's HAL+JSON graph that reports every
+    sensor whose sensor_type passes match, so one traversal finds the
+    sensors of every registered process.  Each level of the crawl is
+    downloaded concurrently on the shared chainHttpClient.
+
+    Several crawlers (in different processes) can split one graph: they
+    share visited, a dict-like object such as a multiprocessing Manager
+    dict, and a resource is only expanded by the first crawler to claim
+    (cycle, uri) in it.
+
+    With a topologyIndex every sensor crawled, matching or not, is recorded
+    in it with its device and title.'''
+
+    def __init__(self, match=None, emit=None, visited=None, cycle=0,
+            follow=FOLLOW_RELS, topology=None):
+
+        self.match = match or (lambda sensor_type: True)
+        self.emit = emit or (lambda uri: None)
+        self.visited = visited
+        self.cycle = cycle
+        self.follow = follow
+        self.topology = topology
+
+        self.seen = set()   #claimed by this crawler
+        self.found = 0
+        self.token = os.getpid()
+
+
+    def claim(self, uri):
+        '''True if uri was not visited yet this cycle, by any crawler; it is
+        then marked visited'''
+
+        if uri in self.seen:
+            return False
+        self.seen.add(uri)
+
+        if self.visited is None:
+            return True
+
+        #setdefault is a single atomic call on a Manager dict
+        return self.visited.setdefault((self.cycle, uri), self.token) == self.token
+
+
+    def links(self, resource):
+        '''hrefs of the followed links of a resource'''
+
+        hrefs = []
+        for rel in self.follow:
+            link = resource.get('_links', {}).get(rel)
+            if isinstance(link, dict):
+                link = [link]
+            for l in link or []:
+                if l.get('href'):
+                    hrefs.append(l['href'])
+        return hrefs
+
+
+    def crawl(self, entry_points, max_frontier=None):
+        '''crawl from entry_points, emitting matching sensor uris.  With
+        max_frontier, stop as soon as the next level holds at least that many
+        uris and return them unvisited (see split), otherwise crawl to the
+        end and return [].'''
+
+        frontier = list(entry_points)
+
+        while frontier:
+            uris = [uri for uri in frontier if self.claim(uri)]
+            resources = get_client().get_json_many(uris)
+
+            next_level = []
+            sensors = []
+            for uri, resource in zip(uris, resources):
+                if not isinstance(resource, dict):
+                    continue
+
+                if 'sensor_type' in resource:
+                    sensors.append((uri, resource))
+                    if self.match(resource['sensor_type']):
+                        self.found += 1
+                        self.emit(uri)
+                else:
+                    next_level.extend(self.links(resource))
+
+            if self.topology is not None and sensors:
+                try:
+                    self.topology.record(sensors)
+                except Exception:
+                    log.exception('could not record %s sensors in the topology index',
+                            len(sensors))
+
+            frontier = next_level
+
+            if max_frontier is not None and len(frontier) >= max_frontier:
+                return list(OrderedDict.fromkeys(uri for uri in frontier
+                        if uri not in self.seen))
+
+        return []
+
+
+    def split(self, entry_points, shards):
+        '''crawl from entry_points only until there are at least shards uris
+        to hand to separate crawlers (or the graph is exhausted), and return
+        them'''
+        return self.crawl(entry_points, max_frontier=shards)
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+from resourceCache import resourceCache
+import os
+import time
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+class chainHttpClient(object):
+    '''shared HTTP access to ChainAPI: one requests session with a keep-alive
+    connection pool and default timeout, plus a bounded thread pool to run
+    several fetches (or whole traversals) at once.  Downloaded json is kept
+    in an LRU resourceCache for cache_ttl seconds, then revalidated with
+    If-None-Match/If-Modified-Since when the server sent an ETag or
+    Last-Modified header.'''
+
+    def __init__(self, timeout=10, pool_size=10, max_workers=8, retries=2,
+            cache_size=10000, cache_ttl=300):
+
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.cache = resourceCache(cache_size, cache_ttl)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._pool = None
+
+
+    def get(self, uri, **kwargs):
+        '''requests.get through the pooled session, with the default timeout'''
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(uri, **kwargs)
+
+
+    def get_json(self, uri, use_cache=True):
+        '''download uri and return its json, or None if it is unreachable.
+        With use_cache, a fresh cached copy is returned without any request
+        and an expired one is revalidated with a conditional GET.'''
+
+        key = ('json', uri)
+        entry = self.cache.get_entry(key) if use_cache else None
+
+        if entry is not None and entry['expires'] > time.time():
+            return entry['value']
+
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            req = self.get(uri, headers=headers)
+
+            if req.status_code == 304 and entry is not None:
+                log.debug( '%s not modified.', uri )
+                self.cache.refresh(key)
+                return entry['value']
+
+            log.info( '%s downloaded.', uri )
+            value = req.json()
+
+            if use_cache and req.ok:
+                self.cache.put(key, value, etag=req.headers.get('ETag'),
+                        last_modified=req.headers.get('Last-Modified'))
+
+            return value
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            log.warn( 'URI "%s" unresponsive', uri )
+            return None
+
+
+    def get_json_many(self, uris):
+        '''download several uris concurrently, returning their json in order'''
+        return self.map(self.get_json, uris)
+
+
+    def map(self, func, items):
+        '''call func on every item using at most max_workers threads and
+        return the results in order.  An item whose call raises is logged and
+        gets None.'''
+
+        items = list(items)
+        if len(items) <= 1:
+            return [self._call(func, item) for item in items]
+
+        return self.pool().map(lambda item: self._call(func, item), items)
+
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_workers)
+        return self._pool
+
+
+    @staticmethod
+    def _call(func, item):
+        try:
+            return func(item)
+        except Exception:
+            log.exception('concurrent fetch of %s failed', item)
+            return None
+
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        self.session.close()
+
+
+_clients = {}
+
+
+def get_client(**kwargs):
+    '''the chainHttpClient for this process.  Clients are kept per pid so a
+    forked worker never shares sockets or threads with its parent; kwargs
+    only apply when this process's client is first created.'''
+
+    pid = os.getpid()
+    if pid not in _clients:
+        _clients.clear()
+        _clients[pid] = chainHttpClient(**kwargs)
+    return _clients[pid]
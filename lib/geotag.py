@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+from nearestJoin import to_seconds
+from timestampNormalizer import default_normalizer
+import numpy as np
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+def point_seconds(points):
+    '''timestamps of a list of datapoints as a float array of epoch seconds,
+    NaN where a timestamp is missing or unparseable'''
+
+    times = default_normalizer.parse_column([p.get('timestamp') for p in points])
+    return np.array([to_seconds(t) if t is not None else np.nan for t in times],
+            dtype=np.float64)
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def geolocation(json):
+    '''(lat, lon, elevation) from a site/device resource's geoLocation, or
+    None if it has none'''
+
+    try:
+        geo = json['geoLocation']
+        return (float(geo['latitude']), float(geo['longitude']),
+                float(geo['elevation']) if geo.get('elevation') is not None else None)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class stationaryLocation(object):
+    '''one fixed position, given to every datapoint'''
+
+    def __init__(self, lat, lon, elevation=None):
+        self.lat = lat
+        self.lon = lon
+        self.elevation = elevation
+
+
+    def tag(self, points):
+        '''add 'lat', 'lon' and 'elevation' to every point, return the count'''
+
+        for p in points:
+            p['lat'] = self.lat
+            p['lon'] = self.lon
+            p['elevation'] = self.elevation
+
+        return len(points)
+
+
+class locationTrack(object):
+    '''the positions of a mobile device over time, sorted by time, so every
+    datapoint of a sensor can be matched to the nearest fix in one
+    searchsorted pass.  A point is only tagged if a fix lies within
+    tolerance seconds of it.'''
+
+    def __init__(self, times, lats, lons, elevations=None, tolerance=60):
+
+        order = np.argsort(times, kind='mergesort')
+        self.times = np.asarray(times, dtype=np.float64)[order]
+        self.lats = np.asarray(lats, dtype=np.float64)[order]
+        self.lons = np.asarray(lons, dtype=np.float64)[order]
+        self.elevations = None
+        if elevations is not None:
+            self.elevations = np.asarray(elevations, dtype=np.float64)[order]
+        self.tolerance = tolerance
+
+
+    @classmethod
+    def from_points(cls, lat_points, lon_points, elevation_points=None, tolerance=60):
+        '''build a track from the datapoints of a device's latitude and
+        longitude (and optionally elevation) sensors, pairing readings that
+        share a timestamp'''
+
+        lat_t, lats = cls.readings(lat_points)
+        lon_t, lons = cls.readings(lon_points)
+        times, lat_i, lon_i = np.intersect1d(lat_t, lon_t, assume_unique=True,
+                return_indices=True)
+
+        elevations = None
+        if elevation_points:
+            ele_t, eles = cls.readings(elevation_points)
+            _, track_i, ele_i = np.intersect1d(times, ele_t, assume_unique=True,
+                    return_indices=True)
+            elevations = np.full(len(times), np.nan)
+            elevations[track_i] = eles[ele_i]
+
+        return cls(times, lats[lat_i], lons[lon_i], elevations, tolerance)
+
+
+    @staticmethod
+    def readings(points):
+        '''sorted unique (times, values) arrays of a sensor's datapoints,
+        dropping points without a timestamp or numeric value'''
+
+        times = point_seconds(points)
+        values = np.array([number(p.get('value')) for p in points], dtype=np.float64)
+
+        ok = ~(np.isnan(times) | np.isnan(values))
+        times, first = np.unique(times[ok], return_index=True)
+        return times, values[ok][first]
+
+
+    def nearest(self, seconds):
+        '''index into the track of the fix nearest each time in seconds, or -1
+        where no fix is within tolerance'''
+
+        seconds = np.asarray(seconds, dtype=np.float64)
+        if not len(self.times):
+            return np.full(len(seconds), -1, dtype=np.intp)
+
+        last = len(self.times) - 1
+        right = np.searchsorted(self.times, seconds).clip(0, last)
+        left = (right - 1).clip(0, last)
+
+        with np.errstate(invalid='ignore'):
+            left_diff = np.abs(seconds - self.times[left])
+            right_diff = np.abs(self.times[right] - seconds)
+            best = np.where(left_diff <= right_diff, left, right)
+            within = np.minimum(left_diff, right_diff) <= self.tolerance
+
+        return np.where(within, best, -1)
+
+
+    def tag(self, points):
+        '''add 'lat', 'lon' and 'elevation' to each point with a fix within
+        tolerance, return the number of points tagged'''
+
+        idx = self.nearest(point_seconds(points))
+        hit = idx >= 0
+
+        lats = self.lats[idx[hit]].tolist()
+        lons = self.lons[idx[hit]].tolist()
+        if self.elevations is not None:
+            eles = [None if e != e else e for e in self.elevations[idx[hit]].tolist()]
+        else:
+            eles = [None] * len(lats)
+
+        for n, i in enumerate(np.flatnonzero(hit).tolist()):
+            p = points[i]
+            p['lat'] = lats[n]
+            p['lon'] = lons[n]
+            p['elevation'] = eles[n]
+
+        return len(lats)
+
+
+    def __len__(self):
+        return len(self.times)
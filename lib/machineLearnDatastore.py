@@ -1,11 +1,27 @@
 #!/usr/bin/python
 
 import pymongo
-from dateutil import parser
+import gridfs
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import cPickle
+import zlib
 import math
+import numbers
+import operator
 import datetime
+import numpy as np
+import time
 import sys
 import logging
+from nearestJoin import nearestNeighborJoin
+from rawDataCache import rawDataCache
+import mongoConnection
+import trainingScheduler
+import metrics
+from timestampNormalizer import parse_timestamp, normalize_timestamps
 
 logging.basicConfig(stream=sys.stderr)
 log = logging.getLogger(__name__)
@@ -16,24 +32,81 @@ ch.setLevel(logging.INFO)
 log.addHandler(ch)
 
 
+#approximate length of one degree of latitude, used to turn lat_lon_range
+#(degrees) into a $geoNear max distance
+METERS_PER_DEGREE = 111320.0
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#collection in each database recording which collections are bucketed
+LAYOUTS_COLLECTION = 'collection_layouts'
+
+#layouts read from mongo, keyed (database name, collection name) -> (layout,
+#time read); a collection's layout only changes through bucket_collection/
+#migrate_to_buckets, and other processes see the change after LAYOUT_TTL
+_layouts = {}
+
+#seconds a process trusts a cached layout before reading it again
+LAYOUT_TTL = 60
+
+#serialized models up to this size are stored in the model document itself,
+#larger ones in GridFS
+INLINE_MODEL_BYTES = 8 * 1024 * 1024
+
+#models loaded in this process, (database, collection) -> (version, model)
+_models = {}
+
+#comparisons bucketed range queries apply to the readings in python
+QUERY_OPERATORS = {'$gt': operator.gt, '$gte': operator.ge,
+        '$lt': operator.lt, '$lte': operator.le, '$ne': operator.ne}
+
+
 class machineLearnMongo(object):
 
-    def __init__(self, db='learnair'):
-        '''initialize mongo and our learnair database'''
-        client = pymongo.MongoClient('localhost', 27017)
-        self.db = client[db]
+    def __init__(self, db='learnair', geo_index=False):
+        '''initialize mongo and our learnair database, on the process-wide
+        client from mongoConnection.  With geo_index, documents also get a
+        GeoJSON 'loc' point, collections get a 2dsphere+timestamp index and
+        get_values_in_range matches on the server with $geoNear.'''
+        self.db = mongoConnection.get_database(db)
+        self.geo_index = geo_index
+        self.last_seen_timestamp = None
 
         self.create_conditions_collection()
 
 
     def create_indexed_collection(self, collection_name):
-        '''initialize collection with timestamp/lat/lon unique index'''
+        '''initialize collection with timestamp/lat/lon unique index (or the
+        bucket/lat/lon unique index if the collection is bucketed)'''
         self.current_collection = self.db[collection_name]
 
-        self.current_collection.create_index( [('timestamp', pymongo.ASCENDING),
+        if self.get_layout(collection_name) is not None:
+            self.create_bucket_index(collection_name)
+            return
+
+        mongoConnection.ensure_index(self.current_collection,
+            [('timestamp', pymongo.ASCENDING),
             ('lat', pymongo.DESCENDING),
             ('lon', pymongo.DESCENDING)], unique=True )
 
+        if self.geo_index:
+            mongoConnection.ensure_index(self.current_collection,
+                [('loc', pymongo.GEOSPHERE),
+                ('timestamp', pymongo.ASCENDING)])
+
+
+    def create_geo_index(self, collection_name):
+        '''add the GeoJSON 'loc' field to every document of an existing
+        collection that lacks it, and build the 2dsphere+timestamp index'''
+
+        self.db[collection_name].update_many(
+                {'loc': {'$exists': False}, 'lat': {'$ne': None}, 'lon': {'$ne': None}},
+                [{'$set': {'loc': {'type': 'Point', 'coordinates': ['$lon', '$lat']}}}])
+
+        mongoConnection.ensure_index(self.db[collection_name],
+                [('loc', pymongo.GEOSPHERE),
+                ('timestamp', pymongo.ASCENDING)])
+
 
     def create_conditions_collection(self):
         '''initialize the conditions database'''
@@ -42,7 +115,7 @@ class machineLearnMongo(object):
 
     def switch_to_collection(self, collection_name, create_if_nonexist=True):
         '''switch to another collection'''
-        if collection_name in self.db.collection_names():
+        if mongoConnection.collection_exists(self.db, collection_name):
             self.current_collection = self.db[collection_name]
         elif create_if_nonexist:
             log.info('created collection %s with timestamp/lat/lon index', collection_name)
@@ -51,7 +124,7 @@ class machineLearnMongo(object):
             log.warn('could not find collection %s, operation failed', collection_name)
 
 
-    def add_data_to_collection(self, collection_name, data):
+    def add_data_to_collection(self, collection_name, data, batch_size=None):
         '''attempt to add each piece of data, if timestamp/lat/lon not unique
         then add to existing.  Data should be formed as [ {'timestamp':x,
         'lat':y, 'lon':z, 'fieldtoadd':xyz}, {'timestamp':x, 'lat':y,'lon':z,
@@ -59,31 +132,30 @@ class machineLearnMongo(object):
 
         returns number of new entries in collection (some may be updated but
         these will not be counted, simply a comparison of size pre/post op).
+
+        if batch_size is given, documents are written with unordered bulk
+        upserts of batch_size documents each (see bulk_add_data_to_collection)
+        and the count of new entries comes from the bulk results.
         '''
 
-        #TODO: slow/unoptimized check of possible timestamp lables on every
-        # iteration to change to 'timestamp'.  Could be optimized so check only
-        # done once.
+        if self.get_layout(collection_name) is not None:
+            return self.add_data_to_buckets(collection_name, data)['inserted']
+
+        if batch_size is not None:
+            return self.bulk_add_data_to_collection(collection_name, data,
+                    batch_size)['inserted']
+
+        start = time.time()
 
         try:
             start_length = self.db.command('collStats', collection_name)['count']
         except:
             log.warn('could not get length of collection')
 
-        for d in data:
-
-            possible_timestamp_labels= ['UTC','utc','Timestamp']
+        normalize_timestamps(data)
+        self.add_geo_points(data)
 
-            for label in possible_timestamp_labels:
-                try:
-                    d['timestamp'] = d.pop(label)
-                except:
-                    pass
-
-            try:
-                d['timestamp'] = self.make_dt(d['timestamp'])
-            except:
-                log.warn('no timestamp found in data %s', d)
+        for d in data:
 
             try:
                 self.db[collection_name].update(
@@ -102,20 +174,414 @@ class machineLearnMongo(object):
         except:
             log.warn('could not get length of collection')
 
+        self.record_upserts(collection_name, {'inserted': length}, start)
+
         return length
 
 
-    def add_conditions(self, data):
-        return self.add_data_to_collection('conditions', data)
+    def bulk_add_data_to_collection(self, collection_name, data, batch_size=1000):
+        '''same upsert semantics as add_data_to_collection, but documents are
+        grouped into unordered bulk writes of batch_size documents so ingest
+        costs one round trip per batch instead of one per document.
+
+        returns a dict {'inserted':x, 'updated':y, 'failed':z} counted from
+        the bulk write results.  Documents without a timestamp/lat/lon are
+        counted as failed and never sent.
+        '''
+
+        if self.get_layout(collection_name) is not None:
+            return self.add_data_to_buckets(collection_name, data)
 
+        start = time.time()
+        counts = {'inserted':0, 'updated':0, 'failed':0}
+        ops = []
 
-    def add_data_to_current_collection(self, data):
-        return self.add_data_to_collection(self.current_collection.name, data)
+        normalize_timestamps(data)
+        self.add_geo_points(data)
+
+        for d in data:
+
+            try:
+                ops.append(UpdateOne(
+                        {   'timestamp': d['timestamp'],
+                            'lat': d['lat'],
+                            'lon': d['lon'] },
+                        { "$set":d },
+                        upsert=True ))
+            except KeyError:
+                log.warn('failed to add %s', d)
+                counts['failed'] += 1
+
+            if len(ops) >= batch_size:
+                self._execute_bulk(collection_name, ops, counts)
+                ops = []
+
+        if ops:
+            self._execute_bulk(collection_name, ops, counts)
+
+        log.info('bulk add to %s: %s inserted, %s updated, %s failed',
+                collection_name, counts['inserted'], counts['updated'],
+                counts['failed'])
+
+        self.record_upserts(collection_name, counts, start)
+
+        return counts
+
+
+    @staticmethod
+    def record_upserts(collection_name, counts, start):
+        '''add an upsert call on collection_name that began at start and its
+        inserted/updated/failed counts to the process metrics'''
+
+        metrics.observe('mongo.upsert.' + collection_name, time.time() - start)
+        for outcome, count in counts.iteritems():
+            metrics.increment('mongo.%s.%s' % (outcome, collection_name), count)
+
+
+    def _execute_bulk(self, collection_name, ops, counts):
+        '''run one unordered bulk write and add its results to counts'''
+
+        try:
+            result = self.db[collection_name].bulk_write(ops, ordered=False)
+            counts['inserted'] += result.upserted_count
+            counts['updated'] += result.matched_count
+
+        except BulkWriteError as e:
+            #unordered, so everything but the reported errors was applied
+            counts['inserted'] += e.details.get('nUpserted', 0)
+            counts['updated'] += e.details.get('nMatched', 0)
+            counts['failed'] += len(e.details.get('writeErrors', []))
+            log.warn('bulk add to %s had %s errors', collection_name,
+                    len(e.details.get('writeErrors', [])))
+
+        except:
+            counts['failed'] += len(ops)
+            log.warn('bulk add of %s documents to %s failed', len(ops),
+                    collection_name)
+
+
+    ##
+    #BUCKETED LAYOUT: one document per location per bucket_seconds, holding
+    #{'bucket': start, 'lat', 'lon', 'count', 'version', 'readings': [{
+    #'timestamp':x, 'fieldtoadd':xyz}, ...]} sorted by timestamp
+    ##
+
+    def get_layout(self, collection_name):
+        '''the layout record of a bucketed collection ({'bucket_seconds':x}),
+        or None for the default one document per reading layout'''
+
+        key = (self.db.name, collection_name)
+        cached = _layouts.get(key)
+        if cached is None or time.time() - cached[1] > LAYOUT_TTL:
+            cached = _layouts[key] = (self.db[LAYOUTS_COLLECTION].find_one(
+                    {'_id': collection_name}), time.time())
+        return cached[0]
+
+
+    def bucket_collection(self, collection_name, bucket_seconds=3600):
+        '''store collection_name (which should be new or empty; see
+        migrate_to_buckets otherwise) in the bucketed layout'''
+
+        layout = {'_id': collection_name, 'layout': 'bucketed',
+                'bucket_seconds': bucket_seconds}
+        self.db[LAYOUTS_COLLECTION].replace_one({'_id': collection_name},
+                layout, upsert=True)
+        _layouts[(self.db.name, collection_name)] = (layout, time.time())
+
+        self.create_bucket_index(collection_name)
+
+
+    def create_bucket_index(self, collection_name):
+        mongoConnection.ensure_index(self.db[collection_name],
+            [('bucket', pymongo.ASCENDING),
+            ('lat', pymongo.DESCENDING),
+            ('lon', pymongo.DESCENDING)], unique=True )
+
+
+    @staticmethod
+    def bucket_start(timestamp, bucket_seconds):
+        '''start of the bucket holding timestamp'''
+        seconds = (utc_naive(timestamp) - EPOCH).total_seconds()
+        return EPOCH + datetime.timedelta(seconds=seconds // bucket_seconds * bucket_seconds)
+
+
+    def add_data_to_buckets(self, collection_name, data, retries=3):
+        '''bucket-aware upsert, same semantics as add_data_to_collection: a
+        reading with an existing timestamp/lat/lon has its fields updated,
+        otherwise it is added.  Each bucket touched is read once, merged in
+        python and written back if nobody else changed it meanwhile (its
+        version is unchanged), retrying up to retries times.
+
+        returns a dict {'inserted':x, 'updated':y, 'failed':z} of readings'''
+
+        start = time.time()
+        bucket_seconds = self.get_layout(collection_name)['bucket_seconds']
+        collection = self.db[collection_name]
+        counts = {'inserted':0, 'updated':0, 'failed':0}
+
+        normalize_timestamps(data)
+
+        groups = {}
+        for d in data:
+            try:
+                key = (self.bucket_start(d['timestamp'], bucket_seconds), d['lat'], d['lon'])
+                groups.setdefault(key, []).append(d)
+            except (KeyError, TypeError, AttributeError):
+                log.warn('failed to add %s', d)
+                counts['failed'] += 1
+
+        for (bucket, lat, lon), docs in groups.iteritems():
+
+            for attempt in range(retries):
+                existing = collection.find_one({'bucket': bucket, 'lat': lat, 'lon': lon})
+                merged, inserted, updated = self.merge_readings(
+                        existing['readings'] if existing else [], docs)
+
+                new_doc = {'bucket': bucket, 'lat': lat, 'lon': lon,
+                        'count': len(merged), 'readings': merged}
+
+                try:
+                    if existing is None:
+                        new_doc['version'] = 0
+                        collection.insert_one(new_doc)
+                        written = True
+                    else:
+                        new_doc['version'] = existing.get('version', 0) + 1
+                        written = collection.replace_one({'_id': existing['_id'],
+                                'version': existing.get('version', 0)},
+                                new_doc).matched_count == 1
+                except DuplicateKeyError:
+                    written = False #another writer created this bucket first
+
+                if written:
+                    counts['inserted'] += inserted
+                    counts['updated'] += updated
+                    break
+            else:
+                log.warn('gave up adding %s readings to bucket %s', len(docs), bucket)
+                counts['failed'] += len(docs)
+
+        log.info('bucket add to %s: %s inserted, %s updated, %s failed',
+                collection_name, counts['inserted'], counts['updated'],
+                counts['failed'])
+
+        self.record_upserts(collection_name, counts, start)
+
+        return counts
+
+
+    @staticmethod
+    def merge_readings(readings, docs):
+        '''merge docs into a bucket's readings by timestamp.  returns the new
+        readings sorted by timestamp and the numbers inserted and updated.
+        Timestamps are keyed and stored as naive UTC, which is what mongo
+        gives back, so aware timestamps of new docs match stored readings.'''
+
+        by_time = dict((utc_naive(r['timestamp']), dict(r)) for r in readings)
+        inserted = updated = 0
+
+        for d in docs:
+            reading = dict((k, v) for k, v in d.iteritems()
+                    if k not in ('_id', 'lat', 'lon', 'loc'))
+            reading['timestamp'] = utc_naive(reading['timestamp'])
+
+            if reading['timestamp'] in by_time:
+                by_time[reading['timestamp']].update(reading)
+                updated += 1
+            else:
+                by_time[reading['timestamp']] = reading
+                inserted += 1
+
+        return [by_time[t] for t in sorted(by_time)], inserted, updated
+
+
+    def find_readings(self, collection_name, query=None, projection=None,
+            sort=False, batch_size=None):
+        '''iterate over the documents of collection_name matching query as
+        flat {'timestamp', 'lat', 'lon', ...} readings, whatever the layout.
+        sort returns them in timestamp order.
+
+        For bucketed collections the timestamp/lat/lon conditions choose the
+        buckets on the server and every condition (equality or $gt, $gte,
+        $lt, $lte, $ne) is then checked per reading.'''
+
+        query = query or {}
+        layout = self.get_layout(collection_name)
+
+        if layout is None:
+            cursor = self.db[collection_name].find(query, projection,
+                    no_cursor_timeout=sort)
+            if sort:
+                cursor = cursor.sort('timestamp', pymongo.ASCENDING)
+            if batch_size is not None:
+                cursor = cursor.batch_size(batch_size)
+            try:
+                for doc in cursor:
+                    yield doc
+            finally:
+                cursor.close()
+            return
+
+        if projection is not None:
+            projection = dict(('readings.' + k, True) for k in projection
+                    if k not in ('lat', 'lon'))
+            projection.update({'bucket': True, 'lat': True, 'lon': True})
+
+        cursor = self.db[collection_name].find(
+                self.bucket_query(query, layout['bucket_seconds']), projection,
+                no_cursor_timeout=sort)
+        if sort:
+            cursor = cursor.sort('bucket', pymongo.ASCENDING)
+        if batch_size is not None:
+            cursor = cursor.batch_size(max(1, batch_size // 100))
+
+        try:
+            pending = []
+            pending_bucket = None
+
+            for bucket in cursor:
+                #buckets starting together are merged so readings stay sorted
+                if sort and pending and bucket['bucket'] != pending_bucket:
+                    pending.sort(key=lambda r: r['timestamp'])
+                    for reading in pending:
+                        yield reading
+                    pending = []
+
+                pending_bucket = bucket['bucket']
+
+                for reading in bucket.get('readings', []):
+                    if self.reading_matches(reading, query):
+                        reading['lat'] = bucket['lat']
+                        reading['lon'] = bucket['lon']
+                        if sort:
+                            pending.append(reading)
+                        else:
+                            yield reading
+
+            pending.sort(key=lambda r: r['timestamp'])
+            for reading in pending:
+                yield reading
+
+        finally:
+            cursor.close()
+
+
+    def bucket_query(self, query, bucket_seconds):
+        '''the bucket documents that can hold readings matching query'''
+
+        bucket_q = dict((k, query[k]) for k in ('lat', 'lon') if k in query)
+        timestamp = query.get('timestamp')
+
+        if isinstance(timestamp, dict):
+            lower = timestamp.get('$gte', timestamp.get('$gt'))
+            upper = timestamp.get('$lte', timestamp.get('$lt'))
+            condition = {}
+            if lower is not None:
+                condition['$gte'] = self.bucket_start(lower, bucket_seconds)
+            if upper is not None:
+                condition['$lte'] = upper
+            if condition:
+                bucket_q['bucket'] = condition
+
+        elif timestamp is not None:
+            bucket_q['bucket'] = self.bucket_start(timestamp, bucket_seconds)
+
+        return bucket_q
+
+
+    @staticmethod
+    def reading_matches(reading, query):
+        '''check a reading against the non lat/lon conditions of query'''
+
+        for key, condition in query.iteritems():
+            if key in ('lat', 'lon'):
+                continue
+
+            value = reading.get(key)
+
+            if isinstance(condition, dict):
+                for op, operand in condition.iteritems():
+                    if value is None or not QUERY_OPERATORS[op](value, operand):
+                        return False
+
+            elif value != condition:
+                return False
+
+        return True
+
+
+    def migrate_to_buckets(self, collection_name, bucket_seconds=3600, batch_size=10000):
+        '''convert an existing one document per reading collection to the
+        bucketed layout.  Readings are copied in timestamp order into a
+        temporary bucketed collection that then replaces the original.
+
+        Stop every process writing to collection_name (the workers) first,
+        and keep them stopped for LAYOUT_TTL seconds after the migration:
+        readings written during the copy are lost with the old collection,
+        and a process that still has the flat layout cached would upsert
+        flat documents into the bucketed collection.'''
+
+        if self.get_layout(collection_name) is not None:
+            log.warn('collection %s is already bucketed', collection_name)
+            return
+
+        temp_name = collection_name + '_bucketing'
+        self.drop_collection(temp_name)
+        self.bucket_collection(temp_name, bucket_seconds)
+
+        total = 0
+        batch = []
+
+        for doc in self.find_readings(collection_name, sort=True, batch_size=batch_size):
+            doc.pop('_id', None)
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                total += self.add_data_to_buckets(temp_name, batch)['inserted']
+                batch = []
+
+        if batch:
+            total += self.add_data_to_buckets(temp_name, batch)['inserted']
+
+        self.db[temp_name].rename(collection_name, dropTarget=True)
+        mongoConnection.forget_collection(self.db, collection_name)
+        mongoConnection.forget_collection(self.db, temp_name)
+
+        self.db[LAYOUTS_COLLECTION].delete_one({'_id': temp_name})
+        _layouts.pop((self.db.name, temp_name), None)
+        self.bucket_collection(collection_name, bucket_seconds)
+
+        log.info('migrated %s readings of %s into %ss buckets', total,
+                collection_name, bucket_seconds)
+
+
+    def add_geo_points(self, data):
+        '''with geo_index, add a GeoJSON 'loc' point to each document that has
+        a lat/lon, in place'''
+
+        if not self.geo_index:
+            return
+
+        for d in data:
+            try:
+                d['loc'] = {'type': 'Point',
+                        'coordinates': [float(d['lon']), float(d['lat'])]}
+            except (KeyError, TypeError, ValueError):
+                pass
+
+
+    def add_conditions(self, data, batch_size=None):
+        return self.add_data_to_collection('conditions', data, batch_size)
+
+
+    def add_data_to_current_collection(self, data, batch_size=None):
+        return self.add_data_to_collection(self.current_collection.name, data,
+                batch_size)
 
 
     def return_ml_array(self, collection_name=None, conditions=None, measure=None,
             extra_conditions=None, update_conditions_first=True, time_range=30,
-            lat_lon_range=1, loc_then_time=True, return_diffs=True):
+            lat_lon_range=1, loc_then_time=True, return_diffs=True,
+            in_memory_join=False, from_cache=None):
         '''
         pass a collection_name for the db collection that will the 'measure', as
         well as fields for conditions and measure arrays. If 'None' is specified,
@@ -129,6 +595,12 @@ class machineLearnMongo(object):
         extra_conditions should be dict in form {"collection_name": ['keya', 'keyb'],
         "collection_name2": None}.  None will pull all values from that array into
         the conditions.
+        If in_memory_join is true, the conditions (and extra_conditions) collections
+        are loaded once and matched to every measurement in one vectorized pass
+        (see nearestJoin) instead of querying mongo for each measurement.
+        from_cache, a dict {"measure_key": sensor uri}, reads the measurements
+        from the raw data cache instead of a collection (so collection_name
+        must be None) and matches them in memory, see join_cached_ml_array.
         This function will return a list of dicts, each dict being one training
         example, with the following form:
         [{'conditions':{'keya':val, 'keyb':val}, 'measures':{'keya':val, 'keyb':val}},
@@ -137,104 +609,351 @@ class machineLearnMongo(object):
          {'conditions':{'keya':val, 'keyb':val}, 'measures':{'keya':val, 'keyb':val}}]
         '''
 
+        if from_cache is not None and collection_name is not None:
+            raise ValueError('return_ml_array reads measurements from either '
+                    'collection_name or from_cache, not both')
+
         if update_conditions_first:
             self.update_conditions_from_api()
 
+        if from_cache is not None:
+            return self.join_cached_ml_array(from_cache, conditions, measure,
+                    extra_conditions, time_range, lat_lon_range, loc_then_time,
+                    return_diffs)
+
         if collection_name is None:
             db = self.current_collection
         else:
             db = self.db[collection_name]
 
+        if in_memory_join:
+            return self.join_ml_array(list(self.find_readings(db.name, {},
+                    self.make_projection(measure))), conditions, measure,
+                    extra_conditions, time_range, lat_lon_range, loc_then_time,
+                    return_diffs)
 
         results=[]
 
-        for doc in db.find({}): #step through each doc in the collection_name db
-
-            this_result = {'conditions':{}, 'measures':{}}
+        #step through each doc in the collection_name db
+        for doc in self.find_readings(db.name, {}, self.make_projection(measure)):
 
             try:
                 #try to get matching conditions for time/geotag given the range
                 con = self.get_values_in_range('conditions', doc['timestamp'],
                         doc['lat'], doc['lon'], time_range,
-                        lat_lon_range, loc_then_time, return_diffs)
+                        lat_lon_range, loc_then_time, return_diffs,
+                        self.make_projection(conditions))
+
+                extras = {}
+                if con is not None and extra_conditions is not None:
+                    for key, val in extra_conditions.iteritems():
+                        try:
+                            extras[key] = self.get_values_in_range(key, doc['timestamp'],
+                                    doc['lat'], doc['lon'], time_range,
+                                    lat_lon_range, loc_then_time, False,
+                                    self.make_projection(val))
+                        except:
+                            extras[key] = None
+
+            except: #something broke when accessing the conditions db
+                log.warn('error accessing condition db for this measurement: %s', doc)
+                continue
 
+            this_result = self.make_training_example(doc, con, extras,
+                    conditions, measure, extra_conditions)
 
-                if con is not None: #found conditions that match the measure
-                    #add values to result array
+            if this_result is not None:
+                results.append(this_result)
 
-                    #take subset of keys if we specify only certain keys
-                    if conditions is not None:
-                        unwanted = set(con.keys()) - set(conditions)
-                        for key in unwanted: del con[key]
+        return results
 
-                    if measure is not None:
-                        unwanted = set(doc.keys()) - set(measure)
-                        for key in unwanted: del doc[key]
 
-                    #add extra_conditions to con
-                    if extra_conditions is not None:
-                        for key, val in extra_conditions.iteritems():
-                            try:
-                                extra = self.get_values_in_range(key, doc['timestamp'],
-                                        doc['lat'], doc['lon'], time_range,
-                                        lat_lon_range, loc_then_time, False)
+    def iter_ml_array(self, collection_name=None, conditions=None, measure=None,
+            extra_conditions=None, update_conditions_first=True, time_range=30,
+            lat_lon_range=1, loc_then_time=True, return_diffs=True,
+            batch_size=1000, start_after=None):
+        '''generator version of return_ml_array that yields lists of training
+        examples (same form and arguments as return_ml_array) instead of
+        building one list for the whole collection.
+
+        Measurements are read in timestamp order from a server side cursor,
+        batch_size at a time; a batch is only cut between timestamps, so it may
+        run slightly over batch_size.  Each batch is matched in memory against
+        only the conditions in its own time window, so memory stays bounded
+        by the batch size rather than the collection size.
+
+        After each batch is yielded, self.last_seen_timestamp holds the
+        timestamp of the last measurement in it.  Pass it back as start_after
+        to resume with the measurements strictly after that timestamp.
+        '''
 
-                                if val is not None:
-                                    unwanted = set(extra.keys()) - set(val)
-                                    for unwanted_key in unwanted: del extra[unwanted_key]
+        if update_conditions_first:
+            self.update_conditions_from_api()
 
-                                con.update(extra)
+        if collection_name is None:
+            db = self.current_collection
+        else:
+            db = self.db[collection_name]
 
-                            except:
-                                log.warn('error adding extra conditions %s', key)
+        query = {}
+        if start_after is not None:
+            query = {'timestamp': {"$gt": self.make_dt(start_after)}}
 
+        readings = self.find_readings(db.name, query, self.make_projection(measure),
+                sort=True, batch_size=batch_size)
+
+        try:
+            docs = []
+
+            for doc in readings:
+                if len(docs) >= batch_size and doc.get('timestamp') != docs[-1].get('timestamp'):
+                    self.last_seen_timestamp = docs[-1].get('timestamp')
+                    yield self.join_ml_array(docs, conditions, measure,
+                            extra_conditions, time_range, lat_lon_range,
+                            loc_then_time, return_diffs)
+                    docs = []
+
+                docs.append(doc)
+
+            if docs:
+                self.last_seen_timestamp = docs[-1].get('timestamp')
+                yield self.join_ml_array(docs, conditions, measure,
+                        extra_conditions, time_range, lat_lon_range,
+                        loc_then_time, return_diffs)
+
+        finally:
+            readings.close()
+
+
+    def join_cached_ml_array(self, fields, conditions=None, measure=None,
+            extra_conditions=None, time_range=30, lat_lon_range=1,
+            loc_then_time=True, return_diffs=True, cache=None):
+        '''training examples, as return_ml_array returns them, for the 'value'
+        column of each sensor uri in fields ({measure_key: uri}) in the raw
+        data cache.  Each chunk's memory-mapped timestamp/lat/lon columns are
+        matched against the conditions (and extra_conditions) in its time
+        window directly (nearestNeighborJoin.match_indexes); a measurement
+        doc is only built for the points that matched.  Points without a
+        geotag are left out.'''
+
+        cache = cache or rawDataCache()
+        time_change = datetime.timedelta(seconds=time_range)
+        results = []
+
+        for key, uri in fields.iteritems():
+            for chunk in cache.iter_chunks(uri, ['value', 'lat', 'lon']):
+                times, values = chunk['timestamp'], chunk['value']
+                lats, lons = chunk['lat'], chunk['lon']
+
+                valid = ~(np.isnan(values) | np.isnan(lats) | np.isnan(lons))
+                if not valid.all():
+                    times, values = times[valid], values[valid]
+                    lats, lons = lats[valid], lons[valid]
+                if not len(times):
+                    continue
+
+                window = {'timestamp': {
+                        "$gte": EPOCH + datetime.timedelta(seconds=float(times[0])) - time_change,
+                        "$lte": EPOCH + datetime.timedelta(seconds=float(times[-1])) + time_change}}
+
+                cons = nearestNeighborJoin(self.find_readings('conditions', window,
+                        self.make_projection(conditions)))
+                queries, matches = cons.match_indexes(times, lats, lons,
+                        time_range, lat_lon_range, loc_then_time)
+
+                #extra conditions are only looked up for the matched points
+                extras = {}
+                for extra, val in (extra_conditions or {}).iteritems():
+                    join = nearestNeighborJoin(self.find_readings(extra, window,
+                            self.make_projection(val)))
+                    found, found_matches = join.match_indexes(times[queries],
+                            lats[queries], lons[queries], time_range,
+                            lat_lon_range, loc_then_time)
+                    extras[extra] = (join, dict(zip(found, found_matches)))
+
+                for n, (q, c) in enumerate(zip(queries, matches)):
+                    doc = {'timestamp': EPOCH + datetime.timedelta(seconds=float(times[q])),
+                            'lat': float(lats[q]), 'lon': float(lons[q]),
+                            key: float(values[q])}
+
+                    con = cons.result(c, doc['timestamp'], doc['lat'], doc['lon'],
+                            return_diffs)
+                    matched_extras = {}
+                    for extra, (join, found) in extras.iteritems():
+                        matched_extras[extra] = None if n not in found else join.result(
+                                found[n], doc['timestamp'], doc['lat'], doc['lon'], False)
+
+                    this_result = self.make_training_example(doc, con, matched_extras,
+                            conditions, measure, extra_conditions)
+                    if this_result is not None:
+                        results.append(this_result)
 
-                    #overwrite any common keys in con with keys from measures
-                    #and remove from measures
-                    overlapping_keys = set(con.keys()).intersection(set(doc))
-                    for key in overlapping_keys:
-                        con[key] = doc[key]
-                        del doc[key]
+        return results
 
-                    #remove mongo document ID
-                    try:
-                        del con['_id']
-                        del doc['_id']
-                    except:
-                        pass
 
-                    #update full results
-                    this_result['conditions'] = con
-                    this_result['measures'] = doc
+    def join_ml_array(self, docs, conditions=None, measure=None,
+            extra_conditions=None, time_range=30, lat_lon_range=1,
+            loc_then_time=True, return_diffs=True):
+        '''build training examples for a list of measurement docs, matching
+        conditions and extra_conditions in memory with nearestNeighborJoin.
+        Same output as return_ml_array.  Only conditions within time_range
+        of the docs' timestamps are loaded.'''
 
-                    results.append(this_result)
-                    log.debug('appended %s', this_result)
+        #only load candidates inside the time window these docs can match
+        times = [d['timestamp'] for d in docs
+                if isinstance(d.get('timestamp'), datetime.datetime)]
+        if not times:
+            return []
 
-                else: #no matching conditions found at timestamp/geotag
-                    log.warn('could not find matching conditions for this measurement: %s', doc)
+        time_change = datetime.timedelta(seconds=time_range)
+        window = {'timestamp': { "$gte": min(times) - time_change,
+                                "$lte": max(times) + time_change }}
 
+        cons = nearestNeighborJoin(self.find_readings('conditions', window,
+                self.make_projection(conditions))).match_documents(docs,
+                time_range, lat_lon_range, loc_then_time, return_diffs)
 
-            except: #something broke when accessing the conditions db
-                log.warn('error accessing condition db for this measurement: %s', doc)
+        extras = {}
+        if extra_conditions is not None:
+            for key, val in extra_conditions.iteritems():
+                extras[key] = nearestNeighborJoin(self.find_readings(key, window,
+                        self.make_projection(val))).match_documents(docs,
+                        time_range, lat_lon_range, loc_then_time, False)
+
+        results = []
+
+        for i, doc in enumerate(docs):
+
+            this_result = self.make_training_example(doc, cons[i],
+                    dict((key, extras[key][i]) for key in extras),
+                    conditions, measure, extra_conditions)
+
+            if this_result is not None:
+                results.append(this_result)
 
         return results
 
 
+    def make_training_example(self, doc, con, extras, conditions=None,
+            measure=None, extra_conditions=None):
+        '''combine a measurement doc with its matched conditions doc (con) and
+        matched extra_conditions docs (extras, keyed by collection name) into
+        one {'conditions':{}, 'measures':{}} training example, keeping only the
+        requested keys.  returns None if no conditions matched.'''
+
+        if con is None: #no matching conditions found at timestamp/geotag
+            log.warn('could not find matching conditions for this measurement: %s', doc)
+            return None
+
+        #take subset of keys if we specify only certain keys
+        if conditions is not None:
+            unwanted = set(con.keys()) - set(conditions)
+            for key in unwanted: del con[key]
+
+        if measure is not None:
+            unwanted = set(doc.keys()) - set(measure)
+            for key in unwanted: del doc[key]
+
+        #add extra_conditions to con
+        if extra_conditions is not None:
+            for key, val in extra_conditions.iteritems():
+                try:
+                    extra = extras[key]
+
+                    if val is not None:
+                        unwanted = set(extra.keys()) - set(val)
+                        for unwanted_key in unwanted: del extra[unwanted_key]
+
+                    con.update(extra)
+
+                except:
+                    log.warn('error adding extra conditions %s', key)
+
+        #overwrite any common keys in con with keys from measures
+        #and remove from measures
+        overlapping_keys = set(con.keys()).intersection(set(doc))
+        for key in overlapping_keys:
+            con[key] = doc[key]
+            del doc[key]
+
+        #remove mongo document ID and geo index point
+        for key in ('_id', 'loc'):
+            con.pop(key, None)
+            doc.pop(key, None)
+
+        this_result = {'conditions':con, 'measures':doc}
+        log.debug('appended %s', this_result)
+
+        return this_result
+
+
+    def return_ml_columns(self, collection_name=None, conditions=None, measure=None,
+            extra_conditions=None, update_conditions_first=True, time_range=30,
+            lat_lon_range=1, loc_then_time=True, return_diffs=True,
+            in_memory_join=True, as_dataframe=False, condition_dtype=None,
+            measure_dtype=None):
+        '''same arguments as return_ml_array, but returns the training set
+        column-oriented as {'conditions': x, 'measures': y}, where x and y are
+        NumPy structured arrays (or pandas DataFrames if as_dataframe) with one
+        row per training example.  See examples_to_columns for column dtypes
+        and condition_dtype/measure_dtype.'''
+
+        examples = self.return_ml_array(collection_name, conditions, measure,
+                extra_conditions, update_conditions_first, time_range,
+                lat_lon_range, loc_then_time, return_diffs, in_memory_join)
+
+        return examples_to_columns(examples, as_dataframe=as_dataframe,
+                condition_dtype=condition_dtype, measure_dtype=measure_dtype)
+
+
+    @staticmethod
+    def make_projection(keys):
+        '''mongo projection for a list of keys plus the timestamp/lat/lon
+        needed to match documents, so unused fields are never sent over the
+        wire.  None (all fields) stays None.'''
+
+        if keys is None:
+            return None
+
+        projection = dict((key, True) for key in keys)
+        projection.update({'timestamp': True, 'lat': True, 'lon': True})
+        return projection
+
+
     def get_values_in_range(self, collection_name, timestamp, lat, lon,
             time_range=30, lat_lon_range=1,
-            loc_then_time=True, return_diffs=True):
+            loc_then_time=True, return_diffs=True, projection=None,
+            geo_near=None):
         '''return one document from collection_name that is the closest fit
         to timestamp, lat/lon in the ranges specified (within 30 seconds of
         timestamp, within 1 degree of lat AND 1 degree of lon by default).
         If there are no documents in this range, return None.
         Sorts by location then time if loc_then_time is true, otherwise sorts
         by time first. return_diffs will add the difference in lat/lon/time
-        to the returned array if true.'''
+        to the returned array if true.  projection limits the fields fetched
+        (see make_projection).  geo_near (default: this instance's geo_index)
+        uses get_nearest_in_range instead.  Bucketed collections go through
+        get_bucketed_values_in_range.'''
+
+        if self.get_layout(collection_name) is not None:
+            return self.get_bucketed_values_in_range(collection_name, timestamp,
+                    lat, lon, time_range, lat_lon_range, loc_then_time,
+                    return_diffs, projection)
+
+        if geo_near is None:
+            geo_near = self.geo_index
+
+        if geo_near:
+            return self.get_nearest_in_range(collection_name, timestamp, lat,
+                    lon, time_range, lat_lon_range, loc_then_time, return_diffs,
+                    projection)
+
+        timestamp = self.make_dt(timestamp)
 
         #first try to access the exact timestamp/lat/lon
-        result = self.db[collection_name].find_one({'timestamp':self.make_dt(timestamp),
+        result = self.db[collection_name].find_one({'timestamp':timestamp,
                 'lat':lat,
-                'lon':lon })
+                'lon':lon }, projection)
 
         if result is not None:
             if return_diffs:
@@ -250,12 +969,12 @@ class machineLearnMongo(object):
             #then pull any in range
             time_change = datetime.timedelta(seconds=time_range)
             result = self.db[collection_name].find({
-                'timestamp':{ "$gte": self.make_dt(timestamp) - time_change,
-                            "$lte": self.make_dt(timestamp) + time_change },
+                'timestamp':{ "$gte": timestamp - time_change,
+                            "$lte": timestamp + time_change },
                 'lat':{ "$gte": lat - lat_lon_range,
                         "$lte": lat + lat_lon_range },
                 'lon':{ "$gte": lon - lat_lon_range,
-                        "$lte": lon + lat_lon_range } })
+                        "$lte": lon + lat_lon_range } }, projection)
 
             if result.count() == 0:
                 log.info('FIND_IN_RANGE: no match found in range.')
@@ -275,7 +994,7 @@ class machineLearnMongo(object):
             else: #choose closest by time
                 time_diff = datetime.timedelta.max
                 for doc in result:
-                    cur_time_diff = abs(self.make_dt(timestamp) - doc['timestamp'])
+                    cur_time_diff = abs(timestamp - doc['timestamp'])
                     if cur_time_diff < time_diff:
                         time_diff = cur_time_diff
                         final_result = doc
@@ -283,18 +1002,102 @@ class machineLearnMongo(object):
             log.info('FIND_IN_RANGE: found a match, diff %s lat, %s long, %s time.',
                     final_result['lat']-lat,
                     final_result['lon']-lon,
-                    final_result['timestamp'] - self.make_dt(timestamp)
+                    final_result['timestamp'] - timestamp
                     )
 
             if return_diffs:
                 final_result['lat_diff'] = float(final_result['lat']-lat)
                 final_result['lon_diff'] = float(final_result['lon']-lon)
                 final_result['distance'] = math.sqrt(final_result['lat_diff']**2 + final_result['lon_diff']**2)
-                final_result['time_diff'] = final_result['timestamp'] - self.make_dt(timestamp)
+                final_result['time_diff'] = final_result['timestamp'] - timestamp
 
             return final_result
 
 
+    def get_bucketed_values_in_range(self, collection_name, timestamp, lat, lon,
+            time_range=30, lat_lon_range=1,
+            loc_then_time=True, return_diffs=True, projection=None):
+        '''get_values_in_range for a bucketed collection: the readings of the
+        buckets in range are unpacked and the closest is chosen in memory'''
+
+        timestamp = self.make_dt(timestamp)
+        time_change = datetime.timedelta(seconds=time_range)
+
+        candidates = self.find_readings(collection_name, {
+                'timestamp':{ "$gte": timestamp - time_change,
+                            "$lte": timestamp + time_change },
+                'lat':{ "$gte": lat - lat_lon_range,
+                        "$lte": lat + lat_lon_range },
+                'lon':{ "$gte": lon - lat_lon_range,
+                        "$lte": lon + lat_lon_range } }, projection)
+
+        result = nearestNeighborJoin(candidates).match([timestamp], [lat], [lon],
+                time_range, lat_lon_range, loc_then_time, return_diffs)[0]
+
+        if result is None:
+            log.info('FIND_IN_RANGE: no match found in range.')
+
+        return result
+
+
+    def get_nearest_in_range(self, collection_name, timestamp, lat, lon,
+            time_range=30, lat_lon_range=1,
+            loc_then_time=True, return_diffs=True, projection=None):
+        '''get_values_in_range computed on the server: a $geoNear on the 'loc'
+        2dsphere index, limited to the time window, returns only the best
+        document.  Distance is true geodesic distance, and lat_lon_range
+        becomes a circle of lat_lon_range * METERS_PER_DEGREE meters rather
+        than a degree box.  With return_diffs the match also gets
+        'distance_m', its distance in meters.'''
+
+        timestamp = self.make_dt(timestamp)
+        time_change = datetime.timedelta(seconds=time_range)
+
+        pipeline = [
+            {'$geoNear': {
+                'near': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+                'distanceField': 'geo_distance',
+                'maxDistance': lat_lon_range * METERS_PER_DEGREE,
+                'query': {'timestamp': { "$gte": timestamp - time_change,
+                                        "$lte": timestamp + time_change }},
+                'spherical': True }},
+            {'$addFields': {'abs_time_diff':
+                {'$abs': {'$subtract': ['$timestamp', timestamp]}}}} ]
+
+        #the other dimension breaks ties, so an exact match always wins
+        if loc_then_time:
+            pipeline.append({'$sort': {'geo_distance': 1, 'abs_time_diff': 1}})
+        else:
+            pipeline.append({'$sort': {'abs_time_diff': 1, 'geo_distance': 1}})
+
+        pipeline.append({'$limit': 1})
+
+        if projection is not None:
+            pipeline.append({'$project': dict(projection, geo_distance=True)})
+
+        found = list(self.db[collection_name].aggregate(pipeline))
+
+        if not found:
+            log.info('FIND_IN_RANGE: no match found in range.')
+            return None
+
+        final_result = found[0]
+        final_result.pop('abs_time_diff', None)
+        distance_m = final_result.pop('geo_distance')
+
+        log.info('FIND_IN_RANGE: found a match %.1fm away, %s time.',
+                distance_m, final_result['timestamp'] - timestamp)
+
+        if return_diffs:
+            final_result['lat_diff'] = float(final_result['lat']-lat)
+            final_result['lon_diff'] = float(final_result['lon']-lon)
+            final_result['distance'] = math.sqrt(final_result['lat_diff']**2 + final_result['lon_diff']**2)
+            final_result['distance_m'] = distance_m
+            final_result['time_diff'] = final_result['timestamp'] - timestamp
+
+        return final_result
+
+
     def update_conditions_from_api(self):
         '''run through documents in conditions, call API using timestamp/geotag
         data, and update/add api data_fields into the conditions database'''
@@ -317,6 +1120,9 @@ class machineLearnMongo(object):
 
     def drop_collection(self, collection_name):
         self.db.drop_collection(collection_name)
+        self.db[LAYOUTS_COLLECTION].delete_one({'_id': collection_name})
+        _layouts.pop((self.db.name, collection_name), None)
+        mongoConnection.forget_collection(self.db, collection_name)
 
 
     def drop_conditions(self):
@@ -347,26 +1153,203 @@ class machineLearnMongo(object):
         if ( type(timestamp) is datetime.datetime ):
             return timestamp
         else:
-            try:
-                return parser.parse(timestamp)
-            except:
-                log.warn('could not parse timestamp string %s', timestamp)
-                return None
+            return parse_timestamp(timestamp)
+
+
+def examples_to_columns(examples, condition_columns=None, measure_columns=None,
+        as_dataframe=False, condition_dtype=None, measure_dtype=None):
+    '''convert a list of training examples as returned by return_ml_array into
+    {'conditions': x, 'measures': y} column-oriented arrays.
+
+    Column dtypes are inferred from the values present: numbers (and bools)
+    are float64 with NaN for missing, datetimes datetime64[us] and
+    timedeltas timedelta64[us] with NaT for missing, anything else object
+    with None for missing.  A column with no values at all is float64, so
+    two batches of the same data (from iter_ml_array, say) can differ in
+    dtype.  To keep them the same, pass the dtype of an earlier batch's
+    array (x.dtype) as condition_dtype/measure_dtype: it fixes both the
+    columns and their dtypes.  Otherwise columns are sorted by name unless
+    condition_columns/measure_columns fix the column list.'''
+
+    return {'conditions': records_to_columns([e['conditions'] for e in examples],
+                condition_columns, as_dataframe, condition_dtype),
+            'measures': records_to_columns([e['measures'] for e in examples],
+                measure_columns, as_dataframe, measure_dtype)}
+
+
+def records_to_columns(records, columns=None, as_dataframe=False, dtype=None):
+    '''turn a list of dicts into a NumPy structured array (or DataFrame)
+    with the dtype rules of examples_to_columns.  A structured dtype fixes
+    the columns and their dtypes.'''
+
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        columns = dtype.names
+    elif columns is None:
+        columns = sorted(set(key for record in records for key in record))
+
+    data = []
+    for key in columns:
+        values = [record.get(key) for record in records]
+        data.append((str(key), column_array(values,
+                dtype[key] if dtype is not None else None)))
+
+    if as_dataframe:
+        import pandas
+        return pandas.DataFrame(dict(data), columns=[name for name, _ in data])
+
+    array = np.zeros(len(records), dtype=[(name, col.dtype) for name, col in data])
+    for name, col in data:
+        array[name] = col
+
+    return array
+
+
+def column_dtype(values):
+    '''the dtype examples_to_columns gives a list of values'''
+
+    present = [v for v in values if v is not None]
+
+    if present and all(isinstance(v, datetime.datetime) for v in present):
+        return np.dtype('datetime64[us]')
+    if present and all(isinstance(v, datetime.timedelta) for v in present):
+        return np.dtype('timedelta64[us]')
+    if all(isinstance(v, numbers.Number) for v in present):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def column_array(values, dtype=None):
+    '''one column of dtype (inferred by column_dtype if None) from a list of
+    values, None for missing'''
+
+    dtype = column_dtype(values) if dtype is None else np.dtype(dtype)
+
+    if dtype.kind == 'M':
+        return np.array([np.datetime64(utc_naive(v), 'us') if v is not None
+                else np.datetime64('NaT', 'us') for v in values], dtype=dtype)
+
+    if dtype.kind == 'm':
+        return np.array([np.timedelta64(v, 'us') if v is not None
+                else np.timedelta64('NaT', 'us') for v in values], dtype=dtype)
+
+    if dtype.kind != 'O':
+        return np.array([v if v is not None else np.nan for v in values],
+                dtype=dtype)
+
+    column = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        column[i] = v
+    return column
+
+
+def utc_naive(timestamp):
+    '''drop tzinfo from an aware datetime after converting it to UTC'''
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.replace(tzinfo=None) - timestamp.utcoffset()
 
 
 class mlModelMongo(object):
+    #versioned store for one trained model: the model is pickled, compressed
+    #and kept as a binary blob (in GridFS if large) with a version stamp.
+    #get() only deserializes when the stored version differs from the one
+    #this process already loaded, and returns None while nothing is stored.
 
     def __init__ (self, collection_name, algorithm, db='learnair_model'):
 
-        client = pymongo.MongoClient('localhost', 27017)
-        self.db = client[db]
+        self.db = mongoConnection.get_database(db)
         self.collection = self.db[collection_name + '_' + algorithm]
+        self._files = None
+        self.cache_key = (db, self.collection.name)
+
+    def files(self):
+        #GridFS for models too large to inline, only opened when first needed
+        if self._files is None:
+            self._files = gridfs.GridFS(self.db, 'models')
+        return self._files
+
+    def post(self, model):
+        #store any picklable model as a new version, replacing the old one in
+        #a single write so readers see either the old or the new model
+        blob = zlib.compress(cPickle.dumps(model, cPickle.HIGHEST_PROTOCOL))
+        version = ObjectId()
+        doc = {'version': version, 'format': 'pickle+zlib', 'size': len(blob)}
+
+        if len(blob) <= INLINE_MODEL_BYTES:
+            doc['blob'] = Binary(blob)
+        else:
+            doc['file_id'] = self.files().put(blob)
 
-    def post(self, list_values):
-        self.collection.update({},{'vals': list_values}, upsert=True)
+        old = self.collection.find_one_and_replace({}, doc, upsert=True)
+        if old is not None and old.get('file_id') is not None:
+            self.files().delete(old['file_id'])
+
+        _models[self.cache_key] = (version, model)
+        log.info('stored model %s version %s (%s bytes)', self.collection.name,
+                version, len(blob))
+
+    def version(self):
+        doc = self.collection.find_one({}, {'version': True})
+        if doc is None:
+            return None
+        return doc.get('version')
 
     def get(self):
-        return self.collection.find({})[0]['vals']
+        cached = _models.get(self.cache_key)
+        if cached is not None and cached[0] == self.version():
+            return cached[1]
+
+        doc = self.collection.find_one({})
+        if doc is None:
+            return None #nothing trained yet
+        try:
+            model = self.load(doc)
+        except gridfs.errors.NoFile:
+            #replaced by a newer version while we were reading it
+            doc = self.collection.find_one({})
+            if doc is None:
+                return None
+            model = self.load(doc)
+
+        if doc.get('version') is not None:
+            _models[self.cache_key] = (doc['version'], model)
+        return model
+
+    def load(self, doc):
+        if 'blob' in doc:
+            return cPickle.loads(zlib.decompress(doc['blob']))
+        if 'file_id' in doc:
+            return cPickle.loads(zlib.decompress(self.files().get(doc['file_id']).read()))
+        return doc['vals'] #stored before models were versioned
+
+
+
+class sensorWatermarkMongo(object):
+    #per sensor high-water mark: the newest timestamp of data that has
+    #already been fetched and processed for that sensor uri
+
+    def __init__(self, db='learnair', collection_name='sensor_watermarks'):
+
+        self.collection = mongoConnection.get_database(db)[collection_name]
+
+    def get(self, uri):
+        doc = self.collection.find_one({'_id': uri})
+        if doc is None:
+            return None
+        return doc['timestamp']
+
+    def post(self, uri, timestamp):
+        #$max so a slower worker can never move a mark backwards
+        self.collection.update_one({'_id': uri},
+                {'$max': {'timestamp': utc_naive(timestamp)}}, upsert=True)
+
+    def clear(self, uri=None):
+        #forget one sensor's mark, or every mark if uri is None
+        if uri is None:
+            self.collection.delete_many({})
+        else:
+            self.collection.delete_one({'_id': uri})
 
 
 
@@ -375,11 +1358,14 @@ class machineLearnAir(object):
     #passed to it, and writes it to the mongo database, and also calls one of
     #several ml algorithms depending on a passed string
 
-    def __init__(self, collection_name='conditions', update_model_with_x_new_entries=100):
+    def __init__(self, collection_name='conditions', update_model_with_x_new_entries=100,
+            batch_size=1000, geo_index=False):
 
         self.update_thresh = update_model_with_x_new_entries
+        self.batch_size = batch_size
         self.collection_name = collection_name
-        self.mongo = machineLearnMongo()
+        self.mongo = machineLearnMongo(geo_index=geo_index)
+        self.models = {}
 
         if collection_name != 'conditions':
             self.conditions = False
@@ -398,14 +1384,44 @@ class machineLearnAir(object):
             return None
 
         #access relevant ml model
-        model = mlModelMongo(self.collection_name, algorithm)
+        model = self.get_model(algorithm)
 
-        #update ml model if necessary
-        if num_updates >= self.update_thresh:
-            getattr(self, algorithm + '_train')(model)
+        #update ml model if necessary; nothing to infer with until one exists
+        if not self.update_model(model, algorithm, num_updates):
+            return None
 
         #use ml model to create post data and return it
-        return getattr(self, algorithm)(data, model)
+        with metrics.timer('ml.infer.' + algorithm):
+            return getattr(self, algorithm)(data, model)
+
+
+    def update_model(self, model, algorithm, num_updates):
+        '''retrain model if num_updates crossed the update threshold, in the
+        background training process if there is one (the current model keeps
+        serving until it finishes).  The first model is always trained here,
+        since there is nothing to serve meanwhile.  Returns False if there is
+        still no stored model to infer with.'''
+
+        has_model = model.version() is not None
+
+        if num_updates >= self.update_thresh:
+            if not has_model or not trainingScheduler.request_training(
+                    self.collection_name, algorithm):
+                with metrics.timer('ml.train.' + algorithm):
+                    getattr(self, algorithm + '_train')(model)
+                has_model = model.version() is not None
+
+        if not has_model:
+            log.info('no %s model for %s yet, skipping inference', algorithm,
+                    self.collection_name)
+        return has_model
+
+
+    def get_model(self, algorithm):
+        '''the mlModelMongo for this collection and algorithm, made once'''
+        if algorithm not in self.models:
+            self.models[algorithm] = mlModelMongo(self.collection_name, algorithm)
+        return self.models[algorithm]
 
 
     def post_data(self, data):
@@ -415,9 +1431,9 @@ class machineLearnAir(object):
 
         #add to mongo database
         if self.conditions:
-            return self.mongo.add_conditions(data)
+            return self.mongo.add_conditions(data, self.batch_size)
         else:
-            return self.mongo.add_data_to_current_collection(data)
+            return self.mongo.add_data_to_current_collection(data, self.batch_size)
 
 
     def svm_train(self, model):
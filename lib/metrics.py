@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from collections import Counter
+from contextlib import contextmanager
+import threading
+import signal
+import glob
+import json
+import time
+import os
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#process-wide metrics settings, change with configure() before starting the
+#processes; each process then calls start() with its own name
+settings = {'stats_dir': None,      #directory for per-process stats files
+        'interval': 10,             #seconds between stats file writes
+        'http_port': None,          #port of the supervisor's metrics endpoint
+        'profile_threshold': None}  #seconds, profile iterations slower than this
+
+#upper bounds (seconds) of the histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1, 2.5, 5, 10, 30, 60, float('inf')]
+
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+_histograms = {}        #name -> {'count', 'sum', 'max', 'buckets'}
+_state = {'pid': None, 'name': None, 'started': time.time(),
+        'last_counters': {}, 'last_time': time.time(), 'writer': None}
+
+
+def configure(stats_dir=None, interval=None, http_port=None, profile_threshold=None):
+    '''set where metrics are exported.  Every process started afterwards
+    writes its snapshot to stats_dir/<name>.json every interval seconds, and
+    the pool supervisor serves all of them as json on http_port.'''
+
+    if stats_dir is not None:
+        settings['stats_dir'] = stats_dir
+    if interval is not None:
+        settings['interval'] = interval
+    if http_port is not None:
+        settings['http_port'] = http_port
+    if profile_threshold is not None:
+        settings['profile_threshold'] = profile_threshold
+
+
+def reset():
+    '''forget everything recorded, e.g. metrics inherited from a parent'''
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+        _state.update(pid=os.getpid(), started=time.time(), last_counters={},
+                last_time=time.time())
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name, value):
+    '''record the current value of something, e.g. a queue length'''
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    '''record one duration in the histogram name'''
+
+    with _lock:
+        h = _histograms.get(name)
+        if h is None:
+            h = _histograms[name] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                    'buckets': [0] * len(BUCKETS)}
+
+        h['count'] += 1
+        h['sum'] += seconds
+        h['max'] = max(h['max'], seconds)
+
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h['buckets'][i] += 1
+                break
+
+
+@contextmanager
+def timer(name):
+    '''time the enclosed block into the histogram name'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start)
+
+
+def quantile(histogram, q):
+    '''upper bound of the bucket holding quantile q of a histogram'''
+
+    rank = q * histogram['count']
+    seen = 0
+    for bound, count in zip(BUCKETS, histogram['buckets']):
+        seen += count
+        if count and seen >= rank:
+            return min(bound, histogram['max'])
+    return histogram['max']
+
+
+def snapshot():
+    '''this process's metrics as a json-able dict: counters, their rate per
+    second since the previous snapshot, gauges and histogram summaries'''
+
+    now = time.time()
+
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        elapsed = max(now - _state['last_time'], 1e-9)
+        rates = dict((k, (v - _state['last_counters'].get(k, 0)) / elapsed)
+                for k, v in counters.iteritems())
+        _state['last_counters'] = counters
+        _state['last_time'] = now
+
+        histograms = {}
+        for name, h in _histograms.iteritems():
+            histograms[name] = {'count': h['count'], 'sum': h['sum'],
+                    'mean': h['sum'] / h['count'] if h['count'] else None,
+                    'max': h['max'], 'p50': quantile(h, 0.5),
+                    'p90': quantile(h, 0.9), 'p99': quantile(h, 0.99),
+                    'buckets': dict(zip([str(b) for b in BUCKETS], h['buckets']))}
+
+    return {'name': _state['name'], 'pid': os.getpid(), 'time': now,
+            'uptime': now - _state['started'], 'counters': counters,
+            'rates': rates, 'gauges': gauges, 'histograms': histograms}
+
+
+def write_stats(path):
+    '''write snapshot() to path, atomically'''
+
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(snapshot(), f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def start(name):
+    '''start exporting this process's metrics as name: a daemon thread writes
+    stats_dir/<name>.json every interval seconds.  Does nothing if no
+    stats_dir is configured.'''
+
+    reset()
+    _state['name'] = name
+
+    if settings['stats_dir'] is None:
+        return
+
+    if not os.path.isdir(settings['stats_dir']):
+        try:
+            os.makedirs(settings['stats_dir'])
+        except OSError:
+            pass #another process made it first
+
+    path = os.path.join(settings['stats_dir'], name + '.json')
+
+    def write():
+        while True:
+            time.sleep(settings['interval'])
+            try:
+                write_stats(path)
+            except (IOError, OSError):
+                log.exception('could not write metrics to %s', path)
+
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    _state['writer'] = writer
+
+
+def read_stats(stats_dir=None):
+    '''the latest snapshot of every process exporting to stats_dir, by name'''
+
+    stats = {}
+    for path in glob.glob(os.path.join(stats_dir or settings['stats_dir'], '*.json')):
+        try:
+            with open(path) as f:
+                stats[os.path.basename(path)[:-len('.json')]] = json.load(f)
+        except (IOError, ValueError):
+            pass #being replaced
+    return stats
+
+
+def serve(port=None, stats_dir=None):
+    '''serve read_stats() as json at http://127.0.0.1:port/metrics from a
+    daemon thread.  Returns the server, or None if no port is configured.'''
+
+    port = port or settings['http_port']
+    if port is None:
+        return None
+
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/metrics'):
+                self.send_error(404)
+                return
+            payload = json.dumps(read_stats(stats_dir), sort_keys=True)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.info('serving metrics on http://127.0.0.1:%s/metrics', port)
+    return server
+
+
+class samplingProfiler(object):
+    '''samples the main thread's stack every interval seconds of CPU time
+    (SIGPROF) while an iteration runs, and logs the most frequent stacks of
+    iterations that took longer than threshold seconds.  Must be used from
+    the main thread; iterations below the threshold cost only the sampling.'''
+
+    def __init__(self, threshold=5, interval=0.005, top=10, depth=40):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.depth = depth
+        self.samples = Counter()
+
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.depth:
+            code = frame.f_code
+            stack.append('%s:%s:%s' % (os.path.basename(code.co_filename),
+                    code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+
+    @contextmanager
+    def iteration(self, label):
+        '''profile the enclosed block, reporting it if it was slow'''
+
+        self.samples.clear()
+        previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, previous)
+            elapsed = time.time() - start
+
+            if elapsed >= self.threshold:
+                increment('slow_iterations')
+                total = sum(self.samples.values())
+                log.warn('%s took %.1fs, %s cpu samples; top stacks:', label,
+                        elapsed, total)
+                for stack, count in self.samples.most_common(self.top):
+                    log.warn('%5.1f%% %s', 100.0 * count / total, stack)
+
+
+@contextmanager
+def no_profile(label):
+    yield
+
+
+def profiler():
+    '''samplingProfiler().iteration if a profile_threshold is configured,
+    otherwise a context manager that does nothing'''
+
+    if settings['profile_threshold'] is None:
+        return no_profile
+    return samplingProfiler(settings['profile_threshold']).iteration
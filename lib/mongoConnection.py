@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import pymongo
+from pymongo.write_concern import WriteConcern
+import threading
+import os
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#process-wide mongo settings, change with configure() before first use
+settings = {'host': 'localhost',
+        'port': 27017,
+        'write_concern': None,      #dict of WriteConcern kwargs, e.g. {'w': 1}
+        'read_preference': None,    #a pymongo.ReadPreference value
+        'client_factory': None,     #MongoClient-like class, e.g. mongomock's
+        'client_options': {'maxPoolSize': 100}}
+
+_lock = threading.Lock()
+_clients = {}       #(pid, host, port) -> MongoClient
+_indexes = set()    #indexes already ensured, never recreated
+_collections = {}   #database name -> set of known collection names
+
+
+def configure(host=None, port=None, write_concern=None, read_preference=None,
+        client_factory=None, **client_options):
+    '''set the connection settings used by every datastore in this process.
+    Clients already created keep their old settings.  client_factory replaces
+    pymongo.MongoClient, e.g. with an in-memory stand-in for benchmarks.'''
+
+    if host is not None:
+        settings['host'] = host
+    if port is not None:
+        settings['port'] = port
+    if write_concern is not None:
+        settings['write_concern'] = write_concern
+    if read_preference is not None:
+        settings['read_preference'] = read_preference
+    if client_factory is not None:
+        settings['client_factory'] = client_factory
+    settings['client_options'].update(client_options)
+
+
+def get_client(host=None, port=None):
+    '''the pooled MongoClient for this process.  Clients are kept per pid, so
+    a forked worker opens its own connections instead of sharing its
+    parent's sockets.'''
+
+    key = (os.getpid(), host or settings['host'], port or settings['port'])
+
+    with _lock:
+        if key not in _clients:
+            for stale in [k for k in _clients if k[0] != key[0]]:
+                del _clients[stale] #inherited from a parent process
+
+            factory = settings['client_factory'] or pymongo.MongoClient
+            _clients[key] = factory(key[1], key[2], connect=False,
+                    **settings['client_options'])
+            log.debug('opened mongo client %s:%s for pid %s', key[1], key[2], key[0])
+
+        return _clients[key]
+
+
+def get_database(name, host=None, port=None):
+    '''database name on the shared client, with the configured write concern
+    and read preference'''
+
+    write_concern = None
+    if settings['write_concern'] is not None:
+        write_concern = WriteConcern(**settings['write_concern'])
+
+    return get_client(host, port).get_database(name, write_concern=write_concern,
+            read_preference=settings['read_preference'])
+
+
+def ensure_index(collection, keys, **kwargs):
+    '''create_index once per process for each collection/index combination'''
+
+    key = (collection.full_name, tuple(keys), tuple(sorted(kwargs.items())))
+
+    if key in _indexes:
+        return
+
+    collection.create_index(keys, **kwargs)
+    add_collection(collection.database, collection.name)
+
+    with _lock:
+        _indexes.add(key)
+
+
+def collection_exists(db, collection_name):
+    '''check for a collection, listing the database's collections only when
+    the name is not already known'''
+
+    known = _collections.get(db.name)
+    if known is not None and collection_name in known:
+        return True
+
+    names = set(db.collection_names())
+    with _lock:
+        _collections[db.name] = names
+
+    return collection_name in names
+
+
+def add_collection(db, collection_name):
+    '''remember that collection_name now exists in db'''
+    with _lock:
+        _collections.setdefault(db.name, set()).add(collection_name)
+
+
+def forget_collection(db, collection_name):
+    '''forget a dropped collection and its ensured indexes'''
+    with _lock:
+        _collections.get(db.name, set()).discard(collection_name)
+        full_name = db.name + '.' + collection_name
+        for key in [k for k in _indexes if k[0] == full_name]:
+            _indexes.discard(key)
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+import numpy as np
+import datetime
+import math
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_seconds(timestamp):
+    '''convert a datetime to float seconds since the epoch (UTC).  Naive
+    datetimes are assumed to already be UTC, which is how mongo returns them'''
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+
+    return (timestamp - EPOCH).total_seconds()
+
+
+class nearestNeighborJoin(object):
+    '''holds the documents of one collection in memory as arrays sorted by
+    time, so the closest document to many (timestamp, lat, lon) points can
+    be found in a single vectorized pass instead of one query per point.
+
+    matching follows machineLearnMongo.get_values_in_range: a candidate must
+    be within time_range seconds and lat_lon_range degrees of lat AND of lon,
+    and the winner is the closest by squared degree distance (loc_then_time)
+    or by absolute time difference.  Ties are broken by the other dimension,
+    so an exact timestamp/lat/lon match always wins.'''
+
+    #max candidate pairs held in memory at once while matching
+    max_candidates = 2000000
+
+    def __init__(self, docs):
+
+        docs = [d for d in docs if self.has_geotag(d)]
+        docs.sort(key=lambda d: to_seconds(d['timestamp']))
+
+        self.docs = docs
+        self.times = np.array([to_seconds(d['timestamp']) for d in docs], dtype=np.float64)
+        self.lats = np.array([d['lat'] for d in docs], dtype=np.float64)
+        self.lons = np.array([d['lon'] for d in docs], dtype=np.float64)
+
+        log.info('JOIN: loaded %s candidate documents', len(docs))
+
+
+    @staticmethod
+    def has_geotag(doc):
+        try:
+            return ( isinstance(doc['timestamp'], datetime.datetime) and
+                    doc['lat'] is not None and doc['lon'] is not None )
+        except KeyError:
+            return False
+
+
+    def match_documents(self, docs, time_range=30, lat_lon_range=1,
+            loc_then_time=True, return_diffs=True):
+        '''return a list the same length as docs, holding the closest matching
+        document (a copy) for each doc, or None if nothing is in range or the
+        doc has no timestamp/lat/lon.'''
+
+        results = [None] * len(docs)
+        valid = [i for i, d in enumerate(docs) if self.has_geotag(d)]
+
+        if not valid or not self.docs:
+            return results
+
+        #split the queries so the candidate pairs stay bounded in memory
+        q_t = np.array([to_seconds(docs[i]['timestamp']) for i in valid], dtype=np.float64)
+        counts = ( np.searchsorted(self.times, q_t + time_range, 'right') -
+                np.searchsorted(self.times, q_t - time_range, 'left') )
+        total = np.cumsum(counts)
+        edges = np.searchsorted(total,
+                np.arange(self.max_candidates, total[-1], self.max_candidates), 'right')
+        edges = [0] + sorted(set(int(e) for e in edges if 0 < e < len(valid))) + [len(valid)]
+
+        for start, end in zip(edges[:-1], edges[1:]):
+            chunk = valid[start:end]
+            matched = self.match([docs[i]['timestamp'] for i in chunk],
+                    [docs[i]['lat'] for i in chunk],
+                    [docs[i]['lon'] for i in chunk],
+                    time_range, lat_lon_range, loc_then_time, return_diffs)
+            for i, result in zip(chunk, matched):
+                results[i] = result
+
+        return results
+
+
+    def match(self, timestamps, lats, lons, time_range=30, lat_lon_range=1,
+            loc_then_time=True, return_diffs=True):
+        '''vectorized closest match for parallel lists of datetimes, lats and
+        lons.  returns a list of matched documents (copies) or None.'''
+
+        q_dt = list(timestamps)
+        q_t = np.array([to_seconds(t) for t in q_dt], dtype=np.float64)
+
+        results = [None] * len(q_dt)
+
+        queries, candidates = self.match_indexes(q_t, lats, lons, time_range,
+                lat_lon_range, loc_then_time)
+
+        for q, c in zip(queries, candidates):
+            results[q] = self.result(c, q_dt[q], lats[q], lons[q], return_diffs)
+
+        log.debug('JOIN: matched %s of %s queries', len(queries), len(q_dt))
+
+        return results
+
+
+    def match_indexes(self, times, lats, lons, time_range=30, lat_lon_range=1,
+            loc_then_time=True):
+        '''the matching on arrays of query epoch seconds, lats and lons (e.g.
+        memory-mapped columns, which are not copied).  returns two int arrays:
+        the indexes of the queries that matched and the index in self.docs of
+        each one's closest document.'''
+
+        q_t = np.asarray(times, dtype=np.float64)
+        q_lat = np.asarray(lats, dtype=np.float64)
+        q_lon = np.asarray(lons, dtype=np.float64)
+
+        none = (np.array([], dtype=np.intp), np.array([], dtype=np.intp))
+        if len(q_t) == 0 or len(self.docs) == 0:
+            return none
+
+        #candidate window in time for every query, from the sorted times
+        lo = np.searchsorted(self.times, q_t - time_range, 'left')
+        hi = np.searchsorted(self.times, q_t + time_range, 'right')
+        counts = hi - lo
+
+        if counts.sum() == 0:
+            return none
+
+        #expand to (query, candidate) pairs
+        group = np.repeat(np.arange(len(q_t)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cand = np.repeat(lo, counts) + offsets
+
+        c_lat = self.lats[cand]
+        c_lon = self.lons[cand]
+        g_lat = q_lat[group]
+        g_lon = q_lon[group]
+
+        in_box = ( (c_lat >= g_lat - lat_lon_range) & (c_lat <= g_lat + lat_lon_range) &
+                (c_lon >= g_lon - lat_lon_range) & (c_lon <= g_lon + lat_lon_range) )
+
+        group = group[in_box]
+        cand = cand[in_box]
+        distance = (c_lat[in_box] - g_lat[in_box])**2 + (c_lon[in_box] - g_lon[in_box])**2
+        time_diff = np.abs(self.times[cand] - q_t[group])
+
+        if loc_then_time:
+            order = np.lexsort((time_diff, distance, group))
+        else:
+            order = np.lexsort((distance, time_diff, group))
+
+        #first entry of each group in sorted order is the best candidate
+        group = group[order]
+        cand = cand[order]
+        first = np.ones(len(group), dtype=bool)
+        first[1:] = group[1:] != group[:-1]
+
+        return group[first], cand[first]
+
+
+    def result(self, c, timestamp, lat, lon, return_diffs=True):
+        '''a copy of document c matched to a query at timestamp/lat/lon, with
+        the differences to the query if return_diffs'''
+
+        result = dict(self.docs[c])
+
+        if return_diffs:
+            result['lat_diff'] = float(result['lat'] - lat)
+            result['lon_diff'] = float(result['lon'] - lon)
+            result['distance'] = math.sqrt(result['lat_diff']**2 + result['lon_diff']**2)
+            result['time_diff'] = result['timestamp'] - timestamp
+
+        return result
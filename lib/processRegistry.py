@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+import importlib
+import pkgutil
+import time
+import os
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+PROCESSES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'processes')
+
+
+class processRegistry(object):
+    '''index of the sensor processing plugins in lib/processes.
+
+    Plugin file names are indexed by lowercase sensor_type when the registry
+    is created; a plugin module is only imported the first time a sensor of
+    its type is looked up.  On import its (metric, unit) combinations are
+    indexed from its DISPATCH table (plugins without one are asked through
+    required_aux_data and the answer is remembered).  Every reload_interval
+    seconds the plugin directory is rescanned and a plugin whose file
+    changed is reloaded, so edits take effect without restarting workers.'''
+
+    def __init__(self, package='lib.processes', path=PROCESSES_PATH, reload_interval=10):
+
+        self.package = package
+        self.path = path
+        self.reload_interval = reload_interval
+
+        self.names = {}     #lowercase sensor_type -> module name
+        self.modules = {}   #module name -> [module, file mtime, last checked]
+        self.handlers = {}  #(module name, metric, unit) -> handler entry
+
+        self.last_scan = 0
+        self.scan()
+
+
+    def scan(self):
+        '''index the plugin names found in the plugin directory'''
+
+        self.names = dict((name.lower(), name) for _, name, _
+                in pkgutil.iter_modules([self.path]))
+        self.last_scan = time.time()
+        log.debug('process registry found %s', sorted(self.names.values()))
+
+
+    def find(self, sensor_type):
+        '''name of the plugin for sensor_type, or None'''
+
+        if time.time() - self.last_scan > self.reload_interval:
+            self.scan()
+
+        try:
+            return self.names.get(sensor_type.lower())
+        except AttributeError:
+            return None
+
+
+    def lookup(self, sensor_type, metric, unit):
+        '''return the handler entry for a sensor, a dict with 'process' (plugin
+        name), 'module', 'function' (None if the plugin has no DISPATCH
+        table) and 'aux' (list of required aux data titles or None).  Returns
+        None if no plugin handles this sensor_type/metric/unit.'''
+
+        name = self.find(sensor_type)
+        if name is None:
+            log.info('sensor_type %s does not match any process', sensor_type)
+            return None
+
+        module = self.module(name)
+        if module is None:
+            return None
+
+        key = (name, metric, unit)
+        if key in self.handlers:
+            return self.handlers[key]
+
+        if hasattr(module, 'DISPATCH'):
+            #the whole table was indexed on import
+            log.info('process %s has no handler for %s/%s', name, metric, unit)
+            return None
+
+        entry = {'process': name, 'module': module, 'function': None,
+                'aux': module.required_aux_data(metric, unit)}
+        self.handlers[key] = entry
+        return entry
+
+
+    def module(self, name):
+        '''the imported plugin module, importing it on first use and reloading
+        it if its file changed'''
+
+        record = self.modules.get(name)
+
+        try:
+            if record is None:
+                module = importlib.import_module(self.package + '.' + name)
+                record = [module, self.mtime(module), time.time()]
+                self.modules[name] = record
+                self.index(name, module)
+
+            elif time.time() - record[2] > self.reload_interval:
+                record[2] = time.time()
+                mtime = self.mtime(record[0])
+                if mtime != record[1]:
+                    log.info('process %s changed, reloading', name)
+                    record[0] = reload(record[0])
+                    record[1] = mtime
+                    self.index(name, record[0])
+
+        except Exception:
+            log.exception('could not load process %s', name)
+            return None if record is None else record[0]
+
+        return record[0]
+
+
+    def index(self, name, module):
+        '''replace the handler entries of plugin name with those of module'''
+
+        for key in [k for k in self.handlers if k[0] == name]:
+            del self.handlers[key]
+
+        for metric, units in getattr(module, 'DISPATCH', {}).iteritems():
+            for unit, handler in units.iteritems():
+                self.handlers[(name, metric, unit)] = {'process': name,
+                        'module': module,
+                        'function': handler.get('function'),
+                        'aux': handler.get('extra_data')}
+
+
+    @staticmethod
+    def mtime(module):
+        try:
+            return os.path.getmtime(module.__file__.replace('.pyc', '.py'))
+        except OSError:
+            return None
@@ -4,19 +4,10 @@
 
 from .. import machineLearnDatastore
 
-#this tells which extra data are required and which functions to use to process
-#a given metric/unit combination for this sensor type
+#looks up the DISPATCH entry (defined at the bottom of this file) for a given
+#metric/unit combination for this sensor type
 def dispatcher(metric, unit):
-    return {
-        'temperature_raw': { 'raw': {
-            'function': raw_to_temp
-            }},
-        'temperature': { 'celcius':{
-            'extra_data': ['O3_raw_work','O3_raw_aux'],
-            'function': temp_to_learned_temp
-            }}
-
-            }.get(metric, None)[unit]
+    return DISPATCH.get(metric, None)[unit]
 
 
 def required_aux_data(metric, unit):
@@ -52,3 +43,18 @@ def raw_to_temp(data):
 
 def temp_to_learned_temp(data):
     pass
+
+
+#this tells which extra data are required and which functions to use to process
+#a given metric/unit combination for this sensor type.  Built once at import
+#(after the functions it names); the process registry indexes it directly.
+DISPATCH = {
+    'temperature_raw': { 'raw': {
+        'function': raw_to_temp
+        }},
+    'temperature': { 'celcius':{
+        'extra_data': ['O3_raw_work','O3_raw_aux'],
+        'function': temp_to_learned_temp
+        }}
+
+        }
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import sqlite3
+import cPickle
+import os
+import time
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#default queue file, next to chainProcessor.py
+QUEUE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'publish_queue.db')
+
+
+class publishQueue(object):
+    '''on-disk write-ahead queue of virtual sensor data waiting to be posted
+    to ChainAPI.  Workers put a process result and carry on; an uploader
+    reads the entries that are due, posts them and acks them, or schedules a
+    retry with exponential backoff.  Entries live in a sqlite file (WAL
+    journal), so anything not yet acked is picked up again after a restart.
+    An entry that failed max_attempts times is kept but no longer retried.
+
+    Each process must open its own publishQueue; several processes can share
+    the same file.'''
+
+    def __init__(self, path=QUEUE_PATH, backoff=5, max_backoff=600, max_attempts=20):
+
+        self.path = path
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uri TEXT NOT NULL,
+                sensor_type TEXT, metric TEXT, unit TEXT,
+                data BLOB,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS entries_due
+                ON entries (next_attempt)''')
+
+
+    def put(self, uri, sensor_type, metric, unit, data):
+        '''queue data for the virtual sensor (sensor_type, metric, unit) on the
+        device of the sensor at uri'''
+
+        self.db.execute('''INSERT INTO entries
+                (uri, sensor_type, metric, unit, data, next_attempt)
+                VALUES (?, ?, ?, ?, ?, ?)''',
+                (uri, sensor_type, metric, unit,
+                sqlite3.Binary(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)),
+                time.time()))
+
+
+    def due(self, limit=500, now=None):
+        '''the oldest entries due for an upload attempt, as dicts with 'id',
+        'uri', 'sensor_type', 'metric', 'unit', 'data' and 'attempts' '''
+
+        if now is None:
+            now = time.time()
+
+        rows = self.db.execute('''SELECT id, uri, sensor_type, metric, unit, data,
+                attempts FROM entries WHERE next_attempt <= ?
+                ORDER BY id LIMIT ?''', (now, limit))
+
+        return [{'id': row[0], 'uri': row[1], 'sensor_type': row[2],
+                'metric': row[3], 'unit': row[4], 'data': cPickle.loads(str(row[5])),
+                'attempts': row[6]} for row in rows]
+
+
+    def ack(self, ids):
+        '''remove uploaded entries'''
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('DELETE FROM entries WHERE id = ?', [(i,) for i in ids])
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+
+    def retry(self, ids, now=None):
+        '''push failed entries back with exponential backoff; entries that
+        reached max_attempts are parked (next_attempt NULL) for inspection'''
+
+        if now is None:
+            now = time.time()
+
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            for i in ids:
+                row = self.db.execute('SELECT attempts FROM entries WHERE id = ?',
+                        (i,)).fetchone()
+                if row is None:
+                    continue
+
+                attempts = row[0] + 1
+                if attempts >= self.max_attempts:
+                    log.error('giving up on publish queue entry %s after %s attempts',
+                            i, attempts)
+                    next_attempt = None
+                else:
+                    next_attempt = now + min(self.max_backoff,
+                            self.backoff * 2 ** (attempts - 1))
+
+                self.db.execute('''UPDATE entries SET attempts = ?, next_attempt = ?
+                        WHERE id = ?''', (attempts, next_attempt, i))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+
+    def __len__(self):
+        '''number of entries still waiting to be uploaded'''
+        return self.db.execute('''SELECT COUNT(*) FROM entries
+                WHERE next_attempt IS NOT NULL''').fetchone()[0]
+
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,409 @@
+#!/usr/bin/python
+
+from geotag import point_seconds, number
+import numpy as np
+import hashlib
+import shutil
+import fcntl
+import json
+import os
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#default cache directory, next to chainProcessor.py
+RAW_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'raw_cache')
+
+#a sensor's small chunks (under half of CHUNK_ROWS) are merged once it has
+#more than this many, so the chunks of frequent incremental fetches don't
+#pile up
+MAX_CHUNKS = 32
+
+#merging stops at chunks of this many rows and larger chunks are never
+#rewritten, so a compaction costs at most this much however long the
+#history is
+CHUNK_ROWS = 100000
+
+
+def missing(column, times):
+    '''values of column for rows that lack it: the timestamp as an ISO string
+    for timestamp_raw, NaN for everything else'''
+
+    if column == 'timestamp_raw':
+        return np.char.add(np.datetime_as_string(
+                (np.asarray(times) * 1e6).astype('datetime64[us]')), 'Z')
+    return np.full(len(times), np.nan)
+
+
+def merge_columns(a, b):
+    '''the rows of two {column: array} sets (neither sharing a timestamp with
+    the other) as one set sorted by timestamp'''
+
+    merged = {}
+    for column in set(a) | set(b):
+        merged[column] = np.concatenate([
+                part[column] if column in part else missing(column, part['timestamp'])
+                for part in (a, b)])
+
+    order = np.argsort(merged['timestamp'], kind='mergesort')
+    return dict((column, values[order]) for column, values in merged.iteritems())
+
+
+class rawDataCache(object):
+    '''on-disk columnar cache of the raw datapoints of every sensor, so data
+    can be reprocessed or models retrained without downloading it again.
+
+    Each sensor uri gets a directory under path holding append-only chunks,
+    one .npy file per column (float64 'timestamp' in epoch seconds, the
+    original timestamp strings as 'timestamp_raw', and float64 'value',
+    'lat', 'lon', 'elevation' and any other numeric field), and a
+    manifest.json listing the chunks in time order.  Columns are opened
+    memory-mapped, so reading a chunk or a time slice of it copies nothing.
+    Once a sensor has more than max_chunks chunks under half of chunk_rows
+    rows, neighbouring chunks are merged into chunks of up to chunk_rows.
+
+    Chunks never overlap in time: points older than the newest cached one
+    are merged into the chunks around them.  A new chunk is written and
+    renamed into place before the manifest that lists it, both under a
+    per-sensor file lock, so readers never see a partial chunk and several
+    processes can share path.'''
+
+    def __init__(self, path=RAW_CACHE_PATH, max_chunks=MAX_CHUNKS, chunk_rows=CHUNK_ROWS):
+
+        self.path = path
+        self.max_chunks = max_chunks
+        self.chunk_rows = chunk_rows
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass #another process made it first
+
+
+    def directory(self, uri):
+        return os.path.join(self.path, hashlib.sha1(uri.encode('utf-8')).hexdigest())
+
+
+    def manifest(self, uri):
+        '''the manifest of uri ({'uri', 'newest', 'rows', 'chunks': [{'name',
+        'rows', 'first', 'last', 'columns'}, ...]}), or None if not cached'''
+
+        try:
+            with open(os.path.join(self.directory(uri), 'manifest.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
+    def write_manifest(self, directory, manifest):
+        path = os.path.join(directory, 'manifest.json')
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, path)
+
+
+    def lock(self, directory):
+        '''an exclusive lock on a sensor's directory, released when the
+        returned file is closed'''
+
+        f = open(os.path.join(directory, 'lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+
+    ##
+    #WRITING
+    ##
+
+    def append(self, uri, points):
+        '''add a list of datapoints (dicts with a 'timestamp') of the sensor at
+        uri, skipping any whose timestamp is already cached.  Points older
+        than the newest cached one (a backfill) are merged into the chunks
+        they overlap, so chunks stay sorted and never overlap.  Returns the
+        number of points added.'''
+
+        times = point_seconds(points)
+        keep = np.flatnonzero(~np.isnan(times))
+        if not len(keep):
+            return 0
+
+        #sorted by time, one point per timestamp
+        keep = keep[np.argsort(times[keep], kind='mergesort')]
+        keep = keep[np.unique(times[keep], return_index=True)[1]]
+
+        directory = self.directory(uri)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+        with self.lock(directory):
+
+            manifest = self.manifest(uri) or {'uri': uri, 'newest': None,
+                    'rows': 0, 'chunks': [], 'next': 0}
+
+            first, last = times[keep[0]], times[keep[-1]]
+            overlapping = [c for c in manifest['chunks']
+                    if c['last'] >= first and c['first'] <= last]
+
+            cached = None
+            if overlapping:
+                cached = self.concatenate(directory, overlapping, None)
+                keep = keep[~np.isin(times[keep], cached['timestamp'])]
+                if not len(keep):
+                    return 0
+
+            columns = self.columns(points, keep, times)
+            if cached is not None:
+                columns = merge_columns(cached, columns)
+
+            chunk = self.write_chunk(directory, manifest, columns)
+            manifest['chunks'] = sorted([c for c in manifest['chunks']
+                    if c not in overlapping] + [chunk], key=lambda c: c['first'])
+            manifest['rows'] += len(keep)
+
+            if manifest['newest'] is not None and first <= manifest['newest']:
+                log.info('added %s points to %s, backfilling before its newest cached point',
+                        len(keep), uri)
+            if manifest['newest'] is None or chunk['last'] > manifest['newest']:
+                manifest['newest'] = chunk['last']
+            self.write_manifest(directory, manifest)
+
+            for old in overlapping:
+                shutil.rmtree(os.path.join(directory, old['name']), ignore_errors=True)
+
+            small = [c for c in manifest['chunks'] if c['rows'] < self.chunk_rows // 2]
+            if len(small) > self.max_chunks:
+                self.compact_locked(directory, manifest, self.chunk_rows)
+
+        return len(keep)
+
+
+    @staticmethod
+    def columns(points, keep, times):
+        '''{column: array} of the points at indexes keep: their epoch seconds,
+        their original timestamp strings and every numeric field'''
+
+        columns = {'timestamp': times[keep]}
+
+        raw = [points[n]['timestamp'] for n in keep]
+        if all(isinstance(t, basestring) for t in raw):
+            columns['timestamp_raw'] = np.array(raw)
+
+        fields = set()
+        for n in keep:
+            fields.update(points[n])
+        fields.discard('timestamp')
+
+        for field in fields:
+            column = np.array([number(points[n].get(field)) for n in keep],
+                    dtype=np.float64)
+            if not np.isnan(column).all():
+                columns[field] = column
+
+        return columns
+
+
+    def write_chunk(self, directory, manifest, columns):
+        '''write columns (equal length, sorted by timestamp) as the next chunk
+        of a sensor and return its manifest entry'''
+
+        name = 'c%06d' % manifest['next']
+        manifest['next'] += 1
+
+        tmp = os.path.join(directory, '.%s.%s.tmp' % (name, os.getpid()))
+        os.makedirs(tmp)
+        for column, values in columns.iteritems():
+            np.save(os.path.join(tmp, column + '.npy'), values)
+        os.rename(tmp, os.path.join(directory, name))
+
+        times = columns['timestamp']
+        return {'name': name, 'rows': len(times), 'first': float(times[0]),
+                'last': float(times[-1]), 'columns': sorted(columns)}
+
+
+    def compact(self, uri):
+        '''merge every chunk of uri into one, so read() returns memory-mapped
+        columns without concatenating'''
+
+        directory = self.directory(uri)
+        if not os.path.isdir(directory):
+            return
+
+        with self.lock(directory):
+            manifest = self.manifest(uri)
+            if manifest is not None and len(manifest['chunks']) > 1:
+                self.compact_locked(directory, manifest, None)
+
+
+    def compact_locked(self, directory, manifest, chunk_rows):
+        '''merge each run of neighbouring chunks into chunks of at most
+        chunk_rows rows (None merges everything into one), leaving chunks
+        that already have chunk_rows alone'''
+
+        groups = [[]]
+        for chunk in manifest['chunks']:
+            rows = sum(c['rows'] for c in groups[-1]) + chunk['rows']
+            if chunk_rows is not None and rows > chunk_rows:
+                groups.append([])
+            groups[-1].append(chunk)
+
+        chunks, old = [], []
+        for group in groups:
+            if len(group) > 1:
+                columns = self.concatenate(directory, group, None)
+                chunks.append(self.write_chunk(directory, manifest, columns))
+                old += group
+            else:
+                chunks += group
+
+        if not old:
+            return
+
+        manifest['chunks'] = chunks
+        self.write_manifest(directory, manifest)
+
+        #readers that mapped the old files keep them until they let go
+        for chunk in old:
+            shutil.rmtree(os.path.join(directory, chunk['name']), ignore_errors=True)
+
+        log.debug('compacted %s chunks of %s into %s', len(old), manifest['uri'],
+                len(chunks))
+
+
+    def clear(self, uri=None):
+        '''forget one sensor's data, or everything if uri is None'''
+
+        if uri is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+        else:
+            shutil.rmtree(self.directory(uri), ignore_errors=True)
+
+
+    ##
+    #READING
+    ##
+
+    def uris(self):
+        '''every cached sensor uri'''
+
+        uris = []
+        for name in os.listdir(self.path):
+            try:
+                with open(os.path.join(self.path, name, 'manifest.json')) as f:
+                    uris.append(json.load(f)['uri'])
+            except (IOError, ValueError, KeyError):
+                pass
+        return uris
+
+
+    def load_chunk(self, directory, chunk, columns=None, since=None, until=None):
+        '''{column: memory-mapped array} of one chunk, sliced to since <=
+        timestamp < until (epoch seconds).  Requested columns the chunk does
+        not have are filled in, see missing().'''
+
+        path = os.path.join(directory, chunk['name'])
+        times = np.load(os.path.join(path, 'timestamp.npy'), mmap_mode='r')
+
+        first = 0 if since is None else np.searchsorted(times, since, 'left')
+        last = len(times) if until is None else np.searchsorted(times, until, 'left')
+
+        wanted = chunk['columns'] if columns is None else ['timestamp'] + [c for c
+                in columns if c != 'timestamp']
+
+        result = {}
+        for column in wanted:
+            if column == 'timestamp':
+                result[column] = times[first:last]
+            elif column in chunk['columns']:
+                result[column] = np.load(os.path.join(path, column + '.npy'),
+                        mmap_mode='r')[first:last]
+            else:
+                result[column] = missing(column, times[first:last])
+        return result
+
+
+    def chunks_in_range(self, chunks, since=None, until=None):
+        return [c for c in chunks if (since is None or c['last'] >= since)
+                and (until is None or c['first'] < until)]
+
+
+    def iter_chunks(self, uri, columns=None, since=None, until=None):
+        '''yield the cached data of uri one chunk at a time, in time order, as
+        {column: memory-mapped array} (see load_chunk); nothing is copied'''
+
+        manifest = self.manifest(uri)
+        if manifest is None:
+            return
+
+        directory = self.directory(uri)
+        for chunk in self.chunks_in_range(manifest['chunks'], since, until):
+            data = self.load_chunk(directory, chunk, columns, since, until)
+            if len(data['timestamp']):
+                yield data
+
+
+    def concatenate(self, directory, chunks, columns, since=None, until=None):
+
+        if columns is None:
+            columns = sorted(set(c for chunk in chunks for c in chunk['columns']))
+
+        parts = [self.load_chunk(directory, chunk, columns, since, until)
+                for chunk in chunks]
+        if len(parts) == 1:
+            return parts[0]
+
+        return dict((column, np.concatenate([p[column] for p in parts])
+                if parts else np.array([], dtype=np.float64)) for column in columns)
+
+
+    def read(self, uri, columns=None, since=None, until=None):
+        '''the cached data of uri as {column: array}, or None if uri is not
+        cached.  The arrays are memory-mapped (zero copy) when the range lies
+        in one chunk, see compact(); otherwise they are concatenated.'''
+
+        manifest = self.manifest(uri)
+        if manifest is None:
+            return None
+
+        chunks = self.chunks_in_range(manifest['chunks'], since, until)
+        if columns is None:
+            columns = sorted(set(c for chunk in manifest['chunks'] for c in chunk['columns']))
+        return self.concatenate(self.directory(uri), chunks, columns, since, until)
+
+
+    def points(self, uri, since=None, until=None):
+        '''the cached data of uri as a list of datapoints like ChainAPI's
+        ({'timestamp': original string, 'value': x, ...}, NaN fields left
+        out), for code that expects downloaded data'''
+
+        data = self.read(uri, since=since, until=until)
+        if data is None:
+            return []
+
+        if 'timestamp_raw' not in data:
+            data['timestamp_raw'] = missing('timestamp_raw', data['timestamp'])
+
+        fields = [c for c in data if c not in ('timestamp', 'timestamp_raw')]
+        points = []
+        for n, t in enumerate(data['timestamp_raw'].tolist()):
+            point = {'timestamp': t}
+            for field in fields:
+                value = data[field][n]
+                if not np.isnan(value):
+                    point[field] = float(value)
+            points.append(point)
+        return points
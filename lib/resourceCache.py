@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+from collections import OrderedDict
+import threading
+import time
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#stands in for a memoized None, which get() can't tell from a miss
+_NOTHING = object()
+
+class resourceCache(object):
+    '''size bounded LRU cache whose entries expire after a ttl (seconds).
+    Entries can carry the ETag/Last-Modified of the response they came
+    from so an expired entry can be revalidated instead of re-downloaded.
+    Safe to share between threads.'''
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get_entry(self, key):
+        '''return the entry dict for key (fresh or expired) or None.  An entry
+        holds 'value', 'expires', 'etag' and 'last_modified'.'''
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry #most recently used goes last
+            return entry
+
+
+    def get(self, key):
+        '''return the cached value for key if it has not expired, else None'''
+
+        entry = self.get_entry(key)
+        if entry is not None and entry['expires'] > time.time():
+            return entry['value']
+        return None
+
+
+    def put(self, key, value, ttl=None, etag=None, last_modified=None):
+
+        if ttl is None:
+            ttl = self.ttl
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = {'value': value,
+                    'expires': time.time() + ttl,
+                    'etag': etag,
+                    'last_modified': last_modified}
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+    def refresh(self, key, ttl=None):
+        '''extend the life of key after it was revalidated'''
+
+        if ttl is None:
+            ttl = self.ttl
+
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]['expires'] = time.time() + ttl
+
+
+    def memoize(self, key, func, ttl=None, empty_ttl=None):
+        '''return the fresh cached value for key, or call func() and cache its
+        result.  Empty results (None, [], {}) are cached for empty_ttl
+        seconds (default ttl) instead, so a missing resource is looked for
+        again sooner than a found one is refreshed.'''
+
+        value = self.get(key)
+        if value is _NOTHING:
+            return None
+        if value is not None:
+            return value
+
+        value = func()
+        if value:
+            self.put(key, value, ttl)
+        else:
+            self.put(key, _NOTHING if value is None else value,
+                    ttl if empty_ttl is None else empty_ttl)
+        return value
+
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+from dateutil import parser
+from dateutil.tz import tzutc
+import numpy as np
+import datetime
+import re
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#formats numpy can parse in bulk (ISO 8601 without a timezone)
+ISO_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+        '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+OTHER_FORMATS = ['%m/%d/%y %H:%M', '%m/%d/%y %H:%M:%S', '%m/%d/%Y %H:%M',
+        '%m/%d/%Y %H:%M:%S', '%m/%d/%y', '%m/%d/%Y', '%Y/%m/%d %H:%M:%S',
+        '%Y/%m/%d %H:%M']
+
+#suffixes marking a timestamp as UTC (ChainAPI's); stripped before the
+#format is inferred and put back as tzinfo, so these strings take the fast path
+UTC_SUFFIXES = ('Z', '+00:00', '+0000')
+
+UTC = tzutc()
+
+DIGITS = re.compile(r'\d')
+
+
+class timestampNormalizer(object):
+    '''parses timestamp strings quickly by inferring their format once and
+    caching it.  Strings are grouped by shape (every digit replaced by 0,
+    so '5/23/16 4:29' -> '0/00/00 0:00'); the first string of a new shape is
+    parsed with dateutil and the candidate strptime format that gives the
+    same datetime is cached for that shape.  Later strings of that shape are
+    parsed with the cached format (in bulk with numpy for ISO formats) and
+    only shapes with no matching format, or values that fail their format,
+    go through dateutil.  A UTC suffix (see UTC_SUFFIXES) is stripped first
+    and the parsed datetime is made UTC aware, as dateutil would.'''
+
+    #labels renamed to 'timestamp', in the order the old per-document loop
+    #applied them (a later label overwrites an earlier one)
+    timestamp_labels = ['UTC', 'utc', 'Timestamp']
+
+    max_cached_formats = 1000
+
+    #samples of a shape tried before giving up and always using dateutil
+    #for it (the first sample may be an outlier like a day-first date)
+    max_inference_attempts = 3
+
+    def __init__(self):
+        self.formats = {}
+        self.failed_inferences = {}
+
+
+    def infer_format(self, value):
+        '''return the cached format for the shape of value, inferring it if this
+        shape is new.  None means use dateutil for this shape.'''
+
+        shape = DIGITS.sub('0', value)
+
+        try:
+            return self.formats[shape]
+        except KeyError:
+            pass
+
+        fmt = None
+        try:
+            expected = parser.parse(value)
+            for candidate in ISO_FORMATS + OTHER_FORMATS:
+                try:
+                    if datetime.datetime.strptime(value, candidate) == expected:
+                        fmt = candidate
+                        break
+                except ValueError:
+                    pass
+        except:
+            pass
+
+        if fmt is None:
+            self.failed_inferences[shape] = self.failed_inferences.get(shape, 0) + 1
+            if self.failed_inferences[shape] < self.max_inference_attempts:
+                return None
+
+        if len(self.formats) >= self.max_cached_formats:
+            self.formats.clear()
+            self.failed_inferences.clear()
+        self.formats[shape] = fmt
+
+        log.debug('timestamp shape %s uses format %s', shape, fmt)
+        return fmt
+
+
+    def parse(self, value):
+        '''parse one timestamp, returning a datetime or None'''
+        return self.parse_column([value])[0]
+
+
+    def parse_column(self, values):
+        '''parse a list of timestamps (datetimes are passed through) and return
+        a list of datetimes, with None for anything unparseable'''
+
+        results = list(values)
+        texts = list(values)
+        by_format = {}
+        fallback = []
+        utc = []
+
+        for i, value in enumerate(values):
+            if isinstance(value, datetime.datetime):
+                continue
+            if not isinstance(value, basestring):
+                fallback.append(i)
+                continue
+
+            for suffix in UTC_SUFFIXES:
+                if value.endswith(suffix):
+                    value = texts[i] = value[:-len(suffix)]
+                    utc.append(i)
+                    break
+
+            fmt = self.infer_format(value)
+            if fmt is None:
+                fallback.append(i)
+            else:
+                by_format.setdefault(fmt, []).append(i)
+
+        for fmt, indexes in by_format.iteritems():
+            fallback.extend(self._parse_with_format(texts, indexes, fmt, results))
+
+        failed = set(fallback)
+        for i in utc:
+            if i not in failed:
+                results[i] = results[i].replace(tzinfo=UTC)
+
+        #dateutil gets the original string, suffix and all
+        for i in fallback:
+            results[i] = self.parse_with_dateutil(values[i])
+
+        return results
+
+
+    def _parse_with_format(self, values, indexes, fmt, results):
+        '''fill results for indexes using fmt, returning the indexes that did
+        not fit the format'''
+
+        if fmt in ISO_FORMATS:
+            try:
+                parsed = np.array([values[i] for i in indexes],
+                        dtype='datetime64[us]').astype(datetime.datetime)
+                for i, dt in zip(indexes, parsed):
+                    results[i] = dt
+                return []
+            except ValueError:
+                pass #one odd value, parse this group one at a time
+
+        failed = []
+        for i in indexes:
+            try:
+                results[i] = datetime.datetime.strptime(values[i], fmt)
+            except ValueError:
+                failed.append(i)
+
+        return failed
+
+
+    @staticmethod
+    def parse_with_dateutil(value):
+        try:
+            return parser.parse(value)
+        except:
+            log.warn('could not parse timestamp string %s', value)
+            return None
+
+
+    def normalize(self, docs):
+        '''rename the timestamp label of every doc to 'timestamp' and cast it to
+        a datetime, in place, parsing the whole column at once.  Every label
+        a doc carries is removed; the last one in timestamp_labels wins.'''
+
+        if not docs:
+            return docs
+
+        present = []
+
+        for d in docs:
+            for label in self.timestamp_labels:
+                if label in d:
+                    d['timestamp'] = d.pop(label)
+
+            if 'timestamp' in d:
+                present.append(d)
+            else:
+                log.warn('no timestamp found in data %s', d)
+
+        parsed = self.parse_column([d['timestamp'] for d in present])
+        for d, dt in zip(present, parsed):
+            d['timestamp'] = dt
+
+        return docs
+
+
+default_normalizer = timestampNormalizer()
+
+
+def parse_timestamp(timestamp):
+    '''parse one timestamp with the process-wide format cache'''
+    return default_normalizer.parse(timestamp)
+
+
+def normalize_timestamps(docs):
+    '''normalize the timestamps of a batch of docs with the process-wide
+    format cache'''
+    return default_normalizer.normalize(docs)
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+from pymongo import UpdateOne
+from resourceCache import resourceCache
+import mongoConnection
+import metrics
+import time
+import os
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#seconds a process trusts what it read from the index before reading it
+#again, so changes the crawler records reach every worker within this time
+TOPOLOGY_TTL = 300
+
+#sensors the crawler has not seen for this many seconds are dropped
+TOPOLOGY_STALE = 86400
+
+#fields of a sensor resource kept in the index
+FIELDS = ('title', 'sensor_type', 'metric', 'unit')
+
+
+class topologyIndex(object):
+    '''which device every sensor belongs to and which sensors (by title) share
+    that device, recorded by the crawler in the mongo collection
+    collection_name as one document per sensor:
+
+        {'_id': sensor uri, 'device': device uri, 'title', 'sensor_type',
+        'metric', 'unit', 'seen': last crawled, 'changed': last changed}
+
+    so a worker resolves a sensor's device and its aux sensors with an index
+    lookup instead of searching the graph.  Lookups are cached in process
+    for ttl seconds; a sensor or device that is not in the index is
+    remembered as missing for the same time.'''
+
+    def __init__(self, db='learnair', collection_name='sensor_topology',
+            ttl=TOPOLOGY_TTL):
+
+        self.collection = mongoConnection.get_database(db)[collection_name]
+        mongoConnection.ensure_index(self.collection, [('device', 1)])
+        mongoConnection.ensure_index(self.collection, [('seen', 1)])
+
+        self.ttl = ttl
+        self.cache = resourceCache(ttl=ttl)
+
+
+    ##
+    #CRAWLER SIDE
+    ##
+
+    def record(self, sensors, now=None):
+        '''record [(uri, resource json), ...] of sensors found by a crawl.
+        Only sensors that are new or whose device, title, type, metric or unit
+        changed are rewritten (and dropped from this process's cache); the
+        rest just get their seen time bumped.  Returns the number changed.'''
+
+        if now is None:
+            now = time.time()
+
+        docs = {}
+        for uri, resource in sensors:
+            try:
+                device = resource['_links']['ch:device']['href']
+            except (KeyError, TypeError):
+                continue
+            doc = dict((field, resource.get(field)) for field in FIELDS)
+            doc['device'] = device
+            docs[uri] = doc
+
+        if not docs:
+            return 0
+
+        known = dict((d['_id'], d) for d in self.collection.find(
+                {'_id': {'$in': docs.keys()}}))
+
+        ops = []
+        for uri, doc in docs.iteritems():
+            old = known.get(uri)
+            if old is not None and all(old.get(k) == v for k, v in doc.iteritems()):
+                continue
+
+            ops.append(UpdateOne({'_id': uri},
+                    {'$set': dict(doc, changed=now, seen=now)}, upsert=True))
+            self.invalidate(uri, doc['device'])
+            if old is not None and old.get('device') != doc['device']:
+                self.invalidate(device=old.get('device'))
+
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+            log.info('topology: %s of %s sensors new or changed', len(ops), len(docs))
+            metrics.increment('topology.changed', len(ops))
+
+        unchanged = [uri for uri in docs if uri in known]
+        if unchanged:
+            self.collection.update_many({'_id': {'$in': unchanged}},
+                    {'$set': {'seen': now}})
+
+        return len(ops)
+
+
+    def prune(self, max_age=TOPOLOGY_STALE, now=None):
+        '''drop sensors not crawled in max_age seconds; returns how many'''
+
+        if now is None:
+            now = time.time()
+
+        removed = self.collection.delete_many({'seen': {'$lt': now - max_age}}).deleted_count
+        if removed:
+            log.info('topology: dropped %s sensors not seen in %ss', removed, max_age)
+            self.cache.clear()
+        return removed
+
+
+    ##
+    #WORKER SIDE
+    ##
+
+    def invalidate(self, uri=None, device=None):
+        '''forget what this process read about a sensor and/or a device'''
+        if uri is not None:
+            self.cache.invalidate(('sensor', uri))
+        if device is not None:
+            self.cache.invalidate(('device', device))
+
+
+    def sensor(self, uri):
+        '''the index document of the sensor at uri, or None'''
+
+        key = ('sensor', uri)
+        doc = self.cache.get(key)
+        if doc is None:
+            doc = self.collection.find_one({'_id': uri}) or False
+            self.cache.put(key, doc)
+        return doc or None
+
+
+    def device_sensors(self, device):
+        '''{title: uri} of the sensors of device'''
+
+        key = ('device', device)
+        sensors = self.cache.get(key)
+        if sensors is None:
+            sensors = dict((d.get('title'), d['_id']) for d in self.collection.find(
+                    {'device': device}, {'title': 1}))
+            self.cache.put(key, sensors)
+        return sensors
+
+
+    def device(self, uri):
+        '''uri of the device of the sensor at uri, or None if not indexed'''
+
+        doc = self.sensor(uri)
+        return doc['device'] if doc is not None else None
+
+
+    def sibling(self, uri, title):
+        '''uri of the sensor titled title on the device of the sensor at uri,
+        or None if either is not indexed'''
+
+        device = self.device(uri)
+        if device is None:
+            return None
+        return self.device_sensors(device).get(title)
+
+
+    def clear(self):
+        self.collection.delete_many({})
+        self.cache.clear()
+
+
+_indexes = {}
+
+def get_index(**kwargs):
+    '''the topologyIndex of this process (kept per pid, like the http and
+    mongo clients); kwargs only apply when it is first created'''
+
+    pid = os.getpid()
+    if pid not in _indexes:
+        _indexes.clear()
+        _indexes[pid] = topologyIndex(**kwargs)
+    return _indexes[pid]
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+from multiprocessing import Process
+from Queue import Empty
+import signal
+import time
+import metrics
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#queue to the training process, set in each worker with set_queue.  While
+#it is None, machineLearnAir trains synchronously as before.
+_queue = None
+
+#most requests read from the queue before checking which keys are due
+MAX_DRAIN = 1000
+
+
+def set_queue(queue):
+    '''send this process's retrain requests to the training process reading
+    queue'''
+    global _queue
+    _queue = queue
+
+
+def request_training(collection_name, algorithm):
+    '''ask the training process to retrain algorithm on collection_name.
+    returns False if there is no training process to ask.'''
+
+    if _queue is None:
+        return False
+
+    _queue.put((collection_name, algorithm))
+    log.info('requested %s training on %s', algorithm, collection_name)
+    return True
+
+
+def create_training_process(queue, stop=None, debounce=60, max_wait=600):
+    return Process(target=training_spawn, args=(queue, stop, debounce, max_wait))
+
+
+def training_spawn(queue, stop=None, debounce=60, max_wait=600):
+    '''train models in the background as requests arrive on queue.
+
+    Requests are debounced per (collection, algorithm): training starts once
+    no new request has arrived for debounce seconds, or max_wait seconds
+    after the first request if they keep coming, so a burst of sensors
+    crossing the update threshold causes one retrain instead of many.  One
+    model trains at a time, and the new model replaces the old in a single
+    write (mlModelMongo.post), so inference keeps using the previous model
+    until the new one is stored.'''
+
+    if stop is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    metrics.start('training')
+    pending = {} #(collection, algorithm) -> [first request, last request]
+
+    while stop is None or not stop.is_set():
+
+        #take the requests that arrive within a second (at most MAX_DRAIN), then
+        #check for due keys, so a steady stream of requests can't hold off
+        #training past max_wait
+        deadline = time.time() + 1
+        for _ in range(MAX_DRAIN):
+            try:
+                key = queue.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                break
+            now = time.time()
+            pending.setdefault(key, [now, now])[1] = now
+            metrics.increment('training.requested')
+            if now >= deadline:
+                break
+
+        now = time.time()
+        due = [key for key, (first, last) in pending.iteritems()
+                if now - last >= debounce or now - first >= max_wait]
+
+        for key in due:
+            del pending[key]
+            train(*key)
+
+    log.info('training process stopped')
+
+
+def train(collection_name, algorithm):
+    '''run machineLearnAir's <algorithm>_train for collection_name'''
+
+    from machineLearnDatastore import machineLearnAir
+
+    start = time.time()
+    try:
+        air = machineLearnAir(collection_name)
+        getattr(air, algorithm + '_train')(air.get_model(algorithm))
+        metrics.observe('ml.train.' + algorithm, time.time() - start)
+        metrics.increment('training.trained')
+        log.info('trained %s on %s in %.1fs', algorithm, collection_name,
+                time.time() - start)
+    except Exception:
+        metrics.increment('training.failed')
+        log.exception('training %s on %s failed', algorithm, collection_name)
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+from collections import OrderedDict
+import sqlite3
+import heapq
+import time
+import os
+import sys
+import logging
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = 0
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+log.addHandler(ch)
+
+
+#default broker state file, next to chainProcessor.py
+BROKER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'broker_state.db')
+
+
+class uriBroker(object):
+    '''priority queue of sensor uris between the crawler and the workers.
+
+    Each sensor is due target_points / rate seconds after it was last
+    processed, where rate is a moving average of the new datapoints per
+    second its previous runs found (clamped to min_interval..max_interval;
+    sensors never seen are due at once), and the uri due first is handed
+    out first.  Busy sensors are thus revisited often and idle ones rarely.
+
+    A uri handed out is in flight until a worker acks it; in-flight uris
+    are kept in a sqlite file at path along with each sensor's rate, so
+    after a crash they are handed out again first.  A uri not acked within
+    ack_timeout seconds is also handed out again.  With reschedule, an
+    acked uri is queued again for its next due time without waiting for the
+    crawler to find it again.  Stats for at most max_size sensors are
+    kept.'''
+
+    def __init__(self, path=BROKER_PATH, max_queue=100000, min_interval=300,
+            max_interval=86400, target_points=100, ack_timeout=600,
+            max_size=100000, reschedule=False, smoothing=0.3):
+
+        self.max_queue = max_queue
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_points = target_points
+        self.ack_timeout = ack_timeout
+        self.max_size = max_size
+        self.reschedule = reschedule
+        self.smoothing = smoothing
+
+        self.heap = []              #(due, seq, uri), stale entries skipped
+        self.queued = {}            #uri -> due, the live heap entries
+        self.inflight = {}          #uri -> time handed out
+        self.stats = OrderedDict()  #uri -> [last processed, points per second]
+        self.seq = 0
+
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS inflight (
+                uri TEXT PRIMARY KEY, sent REAL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS sensors (
+                uri TEXT PRIMARY KEY, last REAL, rate REAL)''')
+
+        self.recover()
+
+
+    def recover(self):
+        '''load sensor stats and queue whatever was in flight at the last
+        shutdown or crash'''
+
+        rows = self.db.execute('''SELECT uri, last, rate FROM sensors
+                ORDER BY last DESC LIMIT ?''', (self.max_size,)).fetchall()
+        for uri, last, rate in reversed(rows):
+            self.stats[uri] = [last, rate]
+
+        inflight = [row[0] for row in self.db.execute('SELECT uri FROM inflight')]
+        self.db.execute('DELETE FROM inflight')
+        for uri in inflight:
+            self.push(uri, 0)
+
+        if inflight:
+            log.info('redelivering %s uris left in flight', len(inflight))
+
+
+    def push(self, uri, due):
+        self.queued[uri] = due
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, uri))
+
+
+    def offer(self, uri):
+        '''queue a uri found by the crawler for its due time.  Returns False
+        if it is already queued or in flight.'''
+
+        if uri in self.queued or uri in self.inflight:
+            return False
+
+        self.push(uri, self.next_due(uri))
+        return True
+
+
+    def next_due(self, uri):
+        '''when uri should next be processed'''
+
+        stat = self.stats.get(uri)
+        if stat is None:
+            return 0
+        last, rate = stat
+        if rate is None:
+            return last + self.min_interval
+
+        interval = self.target_points / rate if rate > 0 else self.max_interval
+        return last + min(self.max_interval, max(self.min_interval, interval))
+
+
+    def full(self):
+        '''True once max_queue uris are waiting; stop taking uris from the
+        crawler until it is False again'''
+        return len(self.queued) >= self.max_queue
+
+
+    def next_time(self):
+        '''due time of the first queued uri, or None if the queue is empty'''
+
+        while self.heap and self.queued.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+
+    def pop(self, now=None):
+        '''the uri due first if it is due by now (it is then in flight), or
+        None'''
+
+        if now is None:
+            now = time.time()
+
+        due = self.next_time()
+        if due is None or due > now:
+            return None
+
+        uri = heapq.heappop(self.heap)[2]
+        del self.queued[uri]
+        self.inflight[uri] = now
+        self.db.execute('INSERT OR REPLACE INTO inflight (uri, sent) VALUES (?, ?)',
+                (uri, now))
+        return uri
+
+
+    def ack(self, uri, points=0, now=None):
+        '''a worker finished uri, finding points new datapoints'''
+
+        if now is None:
+            now = time.time()
+
+        if self.inflight.pop(uri, None) is None:
+            log.debug('ack for %s which is not in flight', uri)
+        self.db.execute('DELETE FROM inflight WHERE uri = ?', (uri,))
+
+        last, rate = self.stats.pop(uri, [None, None])
+        if last is not None:
+            observed = points / max(now - last, 1.0)
+            rate = observed if rate is None else (self.smoothing * observed +
+                    (1 - self.smoothing) * rate)
+
+        self.stats[uri] = [now, rate]
+        while len(self.stats) > self.max_size:
+            self.stats.popitem(last=False)
+        self.db.execute('INSERT OR REPLACE INTO sensors (uri, last, rate) VALUES (?, ?, ?)',
+                (uri, now, rate))
+
+        if self.reschedule:
+            self.offer(uri)
+
+
+    def expire(self, now=None):
+        '''queue again the uris in flight for longer than ack_timeout, due at
+        once; returns them'''
+
+        if now is None:
+            now = time.time()
+
+        expired = [uri for uri, sent in self.inflight.iteritems()
+                if now - sent > self.ack_timeout]
+
+        for uri in expired:
+            del self.inflight[uri]
+            self.db.execute('DELETE FROM inflight WHERE uri = ?', (uri,))
+            self.push(uri, 0)
+
+        if expired:
+            log.warn('%s uris were not acked in %ss, redelivering', len(expired),
+                    self.ack_timeout)
+        return expired
+
+
+    def __len__(self):
+        return len(self.queued)
+
+
+    def close(self):
+        self.db.close()